@@ -0,0 +1,88 @@
+import json
+import logging as log
+import math
+import os
+
+from pyglet.extlibs import png
+
+
+RES_DIR = 'res'
+CACHE_DIR = 'cache'
+SLOT = 32  # Images up to this size go in the atlas, bigger ones stay separate
+PAD = 1  # Edge pixels repeated round each image so scaling does not bleed
+
+
+def sources(res_dir):
+    stats = {}
+    for fname in sorted(os.listdir(res_dir)):
+        if fname.endswith('.png'):
+            stat = os.stat(os.path.join(res_dir, fname))
+            stats[fname] = [stat.st_mtime_ns, stat.st_size]
+    return stats
+
+
+def power_of_two(n):
+    return 1 << max(0, n - 1).bit_length()
+
+
+def build(res_dir=RES_DIR, cache_dir=CACHE_DIR):
+    # Packs every small image in res_dir into cache_dir/atlas.png and writes
+    # where each one went to cache_dir/atlas.json. Needs no OpenGL.
+    stats = sources(res_dir)
+    images = {}
+    for fname in stats:
+        width, height, rows, info = png.Reader(filename=os.path.join(res_dir, fname)).asRGBA8()
+        if width <= SLOT and height <= SLOT:
+            images[fname] = width, height, [bytes(row) for row in rows]
+
+    cell = SLOT + 2 * PAD
+    columns = max(1, math.ceil(math.sqrt(len(images))))
+    atlas_width = power_of_two(columns * cell)
+    atlas_height = power_of_two(math.ceil(len(images) / columns) * cell)
+    canvas = [bytearray(atlas_width * 4) for y in range(atlas_height)]
+
+    regions = {}
+    for i, (fname, (width, height, rows)) in enumerate(images.items()):
+        left, top = i % columns * cell, i // columns * cell
+        for y, row in enumerate([rows[0]] + rows + [rows[-1]]):
+            canvas[top + y][left*4:(left + width + 2)*4] = row[:4] + row + row[-4:]
+        # pyglet counts rows from the bottom
+        regions[fname] = [left + PAD, atlas_height - top - PAD - height, width, height]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'atlas.png'), 'wb') as f:
+        png.Writer(atlas_width, atlas_height, alpha=True).write(f, canvas)
+    table = {'sources': stats, 'regions': regions}
+    with open(os.path.join(cache_dir, 'atlas.json'), 'w') as f:
+        json.dump(table, f, indent=1, sort_keys=True)
+    log.info("Packed %s images into a %sx%s atlas", len(regions), atlas_width, atlas_height)
+    return table
+
+
+def cached_table(res_dir=RES_DIR, cache_dir=CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, 'atlas.json')) as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        table = None
+    if table is None or table['sources'] != sources(res_dir):
+        table = build(res_dir, cache_dir)
+    return table
+
+
+class Atlas:
+    # One texture holding every small image; regions maps file names to the
+    # ready made image regions, so nothing is looked up by path while playing
+
+    def __init__(self, res_dir=RES_DIR, cache_dir=CACHE_DIR):
+        import pyglet.image  # Needs a display, unlike build()
+
+        table = cached_table(res_dir, cache_dir)
+        self.texture = pyglet.image.load(os.path.join(cache_dir, 'atlas.png')).get_texture()
+        self.regions = {fname: self.texture.get_region(*rect)
+                        for fname, rect in table['regions'].items()}
+
+
+if __name__ == "__main__":
+    log.basicConfig(level=log.INFO, format = '%(asctime)s %(message)s')
+    build()
@@ -0,0 +1,144 @@
+import argparse
+import csv
+import sys
+
+import numpy as np
+
+from engine import Monster
+
+
+# Hero sets attack and defense once, at level 1, and level_up never raises them
+HERO_ATTACK = HERO_DEFENSE = 5 + 1//2
+FIGHTS_PER_MINUTE = 6  # How often a hero meets a monster, for the XP rate
+MAX_ROUNDS = 1000  # Fights still going after this many rounds count as lost
+
+
+def hero_max_health(level):
+    return 10 + sum(range(2, level + 1))  # level_up adds the new level each time
+
+
+def tier(level):
+    for low, high, hp, attack, defense, xp in Monster.TIERS:
+        if low < level < high:
+            return hp, attack, defense, xp
+    return None
+
+
+def gaps(levels):
+    return [level for level in levels if tier(level) is None]
+
+
+def calc_damage(rng, attack, defense):
+    # Hero.calc_damage for a whole array of fights at once
+    a = (rng.random(attack.shape) * attack).astype(np.int64)
+    d = (rng.random(defense.shape) * defense).astype(np.int64)
+    return np.maximum(0, a - d)
+
+
+def fight(rng, health, attack, defense, hp, monster_attack, monster_defense):
+    # Hero.fight round by round for every fight in the arrays together, only
+    # carrying on with the fights not decided yet. Returns who won and the
+    # hero health left.
+    health = health.astype(np.int64)
+    hp = hp.astype(np.int64)
+    won = np.zeros(health.shape, bool)
+    going = np.arange(health.size)
+    for rounds in range(MAX_ROUNDS):
+        if not going.size:
+            break
+        dmg = calc_damage(rng, monster_attack[going], defense[going])
+        health[going] -= dmg
+        standing = health[going] > 0
+        going = going[standing]
+
+        dmg = calc_damage(rng, attack[going], monster_defense[going])
+        hp[going] -= dmg
+        killed = hp[going] < 1
+        won[going[killed]] = True
+        going = going[~killed]
+    return won, health
+
+
+def tier_table(levels, armors, swords, fights, rng, fights_per_minute=FIGHTS_PER_MINUTE):
+    # One row per hero level/armor/sword against monsters rolled the way
+    # Monster.statistics rolls them for that level
+    rows = []
+    for level in levels:
+        stats = tier(level)
+        if stats is None:
+            continue
+        configs = [(armor, sword) for armor in armors for sword in swords]
+        n = len(configs) * fights
+        armor = np.repeat([armor for armor, sword in configs], fights)
+        sword = np.repeat([sword for armor, sword in configs], fights)
+        hp, monster_attack, monster_defense, xp = (
+                rng.integers(low, high + 1, n) for low, high in stats)
+        max_health = hero_max_health(level)
+        won, health = fight(rng, np.full(n, max_health), HERO_ATTACK + sword, HERO_DEFENSE + armor,
+                hp, monster_attack, monster_defense)
+
+        won = won.reshape(-1, fights)
+        loss = (max_health - np.maximum(health, 0)).reshape(-1, fights)
+        gained = (won * xp.reshape(-1, fights))
+        for i, (a, s) in enumerate(configs):
+            rows.append({
+                'level': level, 'armor': a, 'sword': s,
+                'win_rate': won[i].mean(),
+                'hp_loss': loss[i].mean(),
+                'xp_per_minute': gained[i].mean() * fights_per_minute,
+            })
+    return rows
+
+
+def grid_table(level, armor, sword, hps, attacks, defenses, fights, rng):
+    # One row per monster HP/DMG/DEF combination against a fixed hero
+    combos = [(hp, a, d) for hp in hps for a in attacks for d in defenses]
+    n = len(combos) * fights
+    hp, monster_attack, monster_defense = (
+            np.repeat([combo[i] for combo in combos], fights) for i in range(3))
+    max_health = hero_max_health(level)
+    won, health = fight(rng, np.full(n, max_health), np.full(n, HERO_ATTACK + sword),
+            np.full(n, HERO_DEFENSE + armor), hp, monster_attack, monster_defense)
+    won = won.reshape(-1, fights)
+    loss = (max_health - np.maximum(health, 0)).reshape(-1, fights)
+    return [{'level': level, 'armor': armor, 'sword': sword,
+             'monster_hp': hp_, 'monster_attack': a, 'monster_defense': d,
+             'win_rate': won[i].mean(), 'hp_loss': loss[i].mean()}
+            for i, (hp_, a, d) in enumerate(combos)]
+
+
+def int_range(text):
+    low, _, high = text.partition('-')
+    return range(int(low), int(high or low) + 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Monte Carlo balance tables for Monster.TIERS")
+    parser.add_argument('--levels', type=int_range, default=int_range('1-50'))
+    parser.add_argument('--armor', type=int_range, default=int_range('0-10'))
+    parser.add_argument('--sword', type=int_range, default=int_range('0-10'))
+    parser.add_argument('--fights', type=int, default=2000, help="fights per table cell")
+    parser.add_argument('--fights-per-minute', type=float, default=FIGHTS_PER_MINUTE)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--csv', help="write the table here instead of printing it")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    rows = tier_table(args.levels, args.armor, args.sword, args.fights, rng, args.fights_per_minute)
+    missing = gaps(args.levels)
+    if missing:
+        print("No monster tier for hero levels:", ' '.join(map(str, missing)), file=sys.stderr)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, ['level', 'armor', 'sword', 'win_rate', 'hp_loss', 'xp_per_minute'])
+            writer.writeheader()
+            writer.writerows(rows)
+        return
+    print("%5s %5s %5s %8s %8s %8s" % ('level', 'armor', 'sword', 'win', 'hp loss', 'xp/min'))
+    for row in rows:
+        print("%(level)5d %(armor)5d %(sword)5d %(win_rate)8.3f %(hp_loss)8.2f %(xp_per_minute)8.2f" % row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import argparse
+import fnmatch
+import json
+import logging as log
+import platform
+import random
+import sys
+import time
+
+from dungeon import generate_dungeon
+from engine import Monster, RandomStreams, World
+
+
+# Map sizes and monster counts measured; --quick stops at the first QUICK of each
+SIZES = [(32, 18), (128, 128), (256, 256), (512, 512), (1024, 1024)]
+MONSTERS = [10, 100, 1000, 10000]
+QUICK = 3
+MONSTER_MAP = (256, 256)  # Room for 10k monsters
+COLLISIONS = 100000
+FOV_CASTS = 1000
+FOV_RADIUS = 8  # gra.Game.FOG_RADIUS
+MONSTER_TICKS = 100  # One second of game time, every monster moves about twice
+THRESHOLD = 0.2  # Slower than the baseline by more than this is a regression
+MIN_DELTA = 0.0005  # Seconds; smaller differences are noise whatever the ratio
+
+
+def make_world(size, seed=1):
+    world = World(seed)
+    world.COLUMNS, world.ROWS = size
+    world.restart()
+    return world
+
+
+def best(run, setup=None, repeat=3):
+    # Fastest of `repeat` runs; setup() is not timed and its result goes to run()
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup else None
+        started = time.perf_counter()
+        run(arg)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def bench_generate(size, repeat):
+    width, height = size
+    rng = random.Random(1)
+    return best(lambda arg: generate_dungeon(width, height, width // 2, height // 2, rng),
+            repeat=repeat), 1
+
+
+def bench_collision(size, repeat):
+    world = make_world(size)
+    rng = random.Random(1)
+    width, height = size
+    cells = [(rng.randrange(width), rng.randrange(height)) for i in range(COLLISIONS)]
+    check = world.hero.check_collision
+
+    def run(arg):
+        for col, row in cells:
+            check(col, row)
+    return best(run, repeat=repeat), COLLISIONS
+
+
+def bench_fov(size, repeat):
+    # Uncached views from cells all over the floor
+    world = make_world(size)
+    rows, cols = world.floor.nonzero()
+    rng = random.Random(1)
+    cells = [(int(cols[i]), int(rows[i])) for i in (rng.randrange(len(cols)) for j in range(FOV_CASTS))]
+
+    def run(arg):
+        for col, row in cells:
+            world.fov.cast(col, row, FOV_RADIUS)
+    return best(run, repeat=repeat), FOV_CASTS
+
+
+def bench_start_level(size, repeat):
+    world = make_world(size)
+
+    def setup():
+        # Same level every time, so runs compare
+        world.rng = RandomStreams(world.seed)
+    return best(lambda arg: world.start_level(), setup, repeat), 1
+
+
+def bench_spawn(count, repeat):
+    def run(world):
+        for i in range(count):
+            Monster()
+    return best(run, lambda: make_world(MONSTER_MAP), repeat), count
+
+
+def bench_spawn_batch(count, repeat):
+    return best(lambda world: world.spawn(Monster, count), lambda: make_world(MONSTER_MAP), repeat), count
+
+
+def bench_monsters(count, repeat):
+    def setup():
+        world = make_world(MONSTER_MAP)
+        world.spawn(Monster, count)
+        return world
+
+    def run(world):
+        for i in range(MONSTER_TICKS):
+            world.clock.step()
+    return best(run, setup, repeat), MONSTER_TICKS
+
+
+def make_game(size):
+    # Needs a display; Xvfb does without a GPU
+    import gra
+
+    gra.pyglet.resource.path = ['res']
+    gra.pyglet.resource.reindex()
+    game = gra.Game(seed=1, visible=False)
+    game.COLUMNS, game.ROWS = size
+    game.restart()
+    return game
+
+
+def bench_draw(size, repeat):
+    # The first frame after start_level, placing a fresh level's bricks up to
+    # Game.PLACE_BUDGET
+    game = make_game(size)
+
+    def setup():
+        game.dirty.update(game.bricks)
+
+    try:
+        return best(lambda arg: game.on_draw(), setup, repeat), min(len(game.bricks), game.PLACE_BUDGET)
+    finally:
+        game.close()
+
+
+def bench_resize(size, repeat):
+    # A resize and zoom plus the frame after, once the level is placed
+    game = make_game(size)
+    game.on_draw()
+
+    def run(arg):
+        game.on_resize(game.width + 1, game.height)
+        game.set_zoom(2)
+        game.set_zoom(1)
+        game.on_draw()
+
+    try:
+        return best(run, repeat=repeat), 1
+    finally:
+        game.close()
+
+
+def cases(quick):
+    sizes = SIZES[:QUICK] if quick else SIZES
+    monsters = MONSTERS[:QUICK] if quick else MONSTERS
+    for width, height in sizes:
+        size = '%sx%s' % (width, height)
+        yield 'generate_dungeon[%s]' % size, bench_generate, (width, height)
+        yield 'check_collision[%s]' % size, bench_collision, (width, height)
+        yield 'start_level[%s]' % size, bench_start_level, (width, height)
+        yield 'fov[%s]' % size, bench_fov, (width, height)
+        yield 'on_draw[%s]' % size, bench_draw, (width, height)
+        yield 'on_resize[%s]' % size, bench_resize, (width, height)
+    for count in monsters:
+        yield 'spawn[%s]' % count, bench_spawn, count
+        yield 'spawn_batch[%s]' % count, bench_spawn_batch, count
+        yield 'Monster.move[%s]' % count, bench_monsters, count
+
+
+def run(quick=False, only=None, repeat=3):
+    results = {}
+    no_display = None
+    for name, bench, param in cases(quick):
+        if only and not any(fnmatch.fnmatch(name, pattern) for pattern in only):
+            continue
+        if bench in (bench_draw, bench_resize) and no_display:
+            log.warning("Skipping %s: %s", name, no_display)
+            continue
+        try:
+            seconds, ops = bench(param, repeat)
+        except Exception as e:
+            if bench not in (bench_draw, bench_resize):
+                raise
+            no_display = e
+            log.warning("Skipping %s: %s", name, no_display)
+            continue
+        results[name] = {'seconds': seconds, 'ops': ops}
+        log.info("%-28s %10.4f s %12.2f us/op", name, seconds, seconds / ops * 1e6)
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    # Names of the benchmarks slower than the baseline by more than threshold
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        new, old = result['seconds'], old['seconds']
+        change = new / old - 1 if old else 0.0
+        slower = change > threshold and new - old > MIN_DELTA
+        log.info("%-28s %10.4f s -> %10.4f s %+7.1f%%%s",
+                name, old, new, change * 100, '  REGRESSION' if slower else '')
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless benchmarks for the dungeon, collision, AI and drawing")
+    parser.add_argument('--quick', action='store_true', help="only the smaller sizes and counts")
+    parser.add_argument('--only', action='append', metavar='PATTERN', help="run matching benchmarks, e.g. 'spawn*'")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', metavar='PATH', help="write the results here as JSON")
+    parser.add_argument('--baseline', metavar='PATH', help="compare with these saved results")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    args = parser.parse_args(argv)
+    log.basicConfig(level=log.INFO, format = '%(asctime)s %(message)s')
+
+    results = run(args.quick, args.only, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'results': results}, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            log.error("%s regressions: %s", len(regressions), ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
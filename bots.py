@@ -0,0 +1,280 @@
+import argparse
+import json
+import logging as log
+import os
+import random
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from engine import ACTION, DIRECTIONS, Chest, Clock, Hero, Monster, World
+
+
+TICKS = 60000  # Ten minutes of game time per session at most
+XP_EVERY = 1000  # Ticks between the points of a session's XP curve
+SEARCH_LIMIT = 4096  # Cells a bot looks through for its next goal
+STEPS = {(direction.dcol, direction.drow): direction for direction in DIRECTIONS}
+
+
+class BotWorld(World):
+    # A headless world that counts the levels it goes down
+    depth = 0
+
+    def start_level(self):
+        self.depth += 1
+        super().start_level()
+
+
+class Policy:
+    # Picks the hero's next step. Every step is taken with ACTION held, the
+    # way a player holds space: into a free cell it walks, into a monster it
+    # fights, into a chest or door it opens them. Heads for the nearest cell
+    # goals() gives, else the nearest one it has not been on this level, and
+    # keeps to that route until it stops leading anywhere wanted.
+    name = None
+
+    def __init__(self, world, rng):
+        self.world = world
+        self.rng = rng
+        self.level = None
+        self.visited = set()
+        self.route = deque()  # Cells still to walk through, the goal last
+
+    def goals(self):
+        return ()
+
+    def choose(self):
+        world, hero = self.world, self.world.hero
+        pos = hero.col, hero.row
+        if self.level != world.depth:
+            self.level = world.depth
+            self.visited = set()
+            self.route.clear()
+        self.visited.add(pos)
+        if self.route and self.route[0] == pos:
+            self.route.popleft()
+
+        goals = set(self.goals())
+        route = self.route
+        if (not route or abs(route[0][0] - pos[0]) + abs(route[0][1] - pos[1]) != 1
+                or not (route[-1] in goals if goals else route[-1] not in self.visited)):
+            route = self.search(goals.__contains__) if goals else None
+            if route is None:
+                route = self.search(lambda cell: cell not in self.visited)
+            self.route = route or deque()
+        if not self.route:
+            return self.rng.choice(DIRECTIONS)
+        col, row = self.route[0]
+        return STEPS[col - pos[0], row - pos[1]]
+
+    def search(self, is_goal):
+        # Shortest way over the floor to a goal cell by breadth-first search,
+        # the cells after the hero's up to the goal; None if none is in reach
+        floor = self.world.floor
+        start = self.world.hero.col, self.world.hero.row
+        came_from = {start: None}
+        queue = deque([start])
+        directions = list(DIRECTIONS)
+        self.rng.shuffle(directions)  # Ties go a different way each time
+        while queue and len(came_from) < SEARCH_LIMIT:
+            col, row = pos = queue.popleft()
+            if pos != start and is_goal(pos):
+                route = deque()
+                while pos != start:
+                    route.appendleft(pos)
+                    pos = came_from[pos]
+                return route
+            for direction in directions:
+                step = col + direction.dcol, row + direction.drow
+                if step not in came_from and floor[step[1], step[0]]:
+                    came_from[step] = pos
+                    queue.append(step)
+        return None
+
+
+class Explore(Policy):
+    name = 'explore'
+
+
+class ChaseChests(Policy):
+    # Empties every chest and picks up what falls out before looking further
+    name = 'chase-chests'
+
+    def goals(self):
+        world = self.world
+        return [(brick.col, brick.row) for brick in (*world.chests, *world.loot)]
+
+
+class DescendFast(Policy):
+    # Straight for the trapdoor
+    name = 'descend-fast'
+
+    def goals(self):
+        return [(door.col, door.row) for door in self.world.doors]
+
+
+POLICIES = {policy.name: policy for policy in (Explore, ChaseChests, DescendFast)}
+
+
+def play(policy, seed, ticks=TICKS, columns=World.COLUMNS, rows=World.ROWS):
+    # One session, until the hero dies or ticks run out. The hero steps
+    # every Hero.STEP like a held key repeats.
+    world = BotWorld(seed)
+    world.COLUMNS, world.ROWS = columns, rows
+    world.restart()
+    bot = POLICIES[policy](world, random.Random(seed))
+    hero = world.hero
+    step = round(Hero.STEP / Clock.TICK)
+    xp = [(0, 0, hero.level)]
+    fights = chests = 0
+
+    started = time.perf_counter()
+    while world.clock.ticks < ticks and hero.health > 0:
+        direction = bot.choose()
+        ahead = world.check_collision(hero.col + direction.dcol, hero.row + direction.drow)
+        fights += isinstance(ahead, Monster) and not ahead.in_fight
+        chests += isinstance(ahead, Chest) and not ahead.is_open
+        world.keys = {direction, ACTION}
+        hero.step(0)
+        world.keys.clear()
+        for i in range(step):
+            world.clock.step()
+            if world.clock.ticks % XP_EVERY == 0:
+                xp.append((world.clock.ticks, hero.xp, hero.level))
+        if world.next_level and not world.next_level.done:
+            world.next_level.step(world.STAGE_BUDGET)
+        world.dirty.clear()
+    seconds = time.perf_counter() - started
+    return {
+        'policy': policy,
+        'seed': seed,
+        'depth': world.depth,
+        'died': hero.health <= 0,
+        'ticks': world.clock.ticks,
+        'seconds': seconds,
+        'ticks_per_second': world.clock.ticks / seconds if seconds else 0.0,
+        'level': hero.level,
+        'xp': hero.xp,
+        'xp_curve': xp,
+        'armor': hero.armor,
+        'sword': hero.sword,
+        'fights': fights,
+        'chests': chests,
+    }
+
+
+def _play(job):
+    return play(*job)
+
+
+class Aggregate:
+    # Running totals per policy of the sessions streamed in so far
+    def __init__(self):
+        self.policies = {}
+
+    def add(self, session):
+        totals = self.policies.setdefault(session['policy'], {
+            'sessions': 0, 'deaths': 0, 'depth': 0, 'max_depth': 0, 'level': 0,
+            'ticks': 0, 'seconds': 0.0, 'xp_curve': {}})
+        totals['sessions'] += 1
+        totals['deaths'] += session['died']
+        totals['depth'] += session['depth']
+        totals['max_depth'] = max(totals['max_depth'], session['depth'])
+        totals['level'] += session['level']
+        totals['ticks'] += session['ticks']
+        totals['seconds'] += session['seconds']
+        for tick, xp, level in session['xp_curve']:
+            point = totals['xp_curve'].setdefault(tick, [0, 0])
+            point[0] += 1
+            point[1] += xp
+
+    def summary(self):
+        rows = []
+        for policy, totals in sorted(self.policies.items()):
+            n = totals['sessions']
+            rows.append({
+                'policy': policy,
+                'sessions': n,
+                'death_rate': totals['deaths'] / n,
+                'mean_depth': totals['depth'] / n,
+                'max_depth': totals['max_depth'],
+                'mean_level': totals['level'] / n,
+                'ticks': totals['ticks'],
+                'ticks_per_second': totals['ticks'] / totals['seconds'] if totals['seconds'] else 0.0,
+                # Mean XP of the sessions still going at each point
+                'xp_curve': [(tick, xp / count) for tick, (count, xp) in sorted(totals['xp_curve'].items())],
+            })
+        return rows
+
+
+def run(policies, sessions, seed=0, ticks=TICKS, columns=World.COLUMNS, rows=World.ROWS,
+        workers=None, on_session=None):
+    # Plays sessions games of every policy on worker processes, handing
+    # each finished one to on_session as it streams in
+    jobs = [(policy, seed + i, ticks, columns, rows) for policy in policies for i in range(sessions)]
+    workers = workers or os.cpu_count()
+    aggregate = Aggregate()
+    started = time.perf_counter()
+    if workers > 1 and len(jobs) > 1:
+        pool = ProcessPoolExecutor(workers)
+        results = pool.map(_play, jobs, chunksize=max(1, min(16, len(jobs) // (4 * workers))))
+    else:
+        pool = None
+        results = map(_play, jobs)
+    try:
+        for session in results:
+            aggregate.add(session)
+            if on_session:
+                on_session(session)
+    finally:
+        if pool:
+            pool.shutdown()
+    return aggregate, time.perf_counter() - started
+
+
+def size(text):
+    columns, _, rows = text.partition('x')
+    return int(columns), int(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play many headless sessions with bots, on every core")
+    parser.add_argument('--policy', action='append', choices=sorted(POLICIES),
+            help="bot to play with, more than once for several (default all)")
+    parser.add_argument('--sessions', type=int, default=100, help="sessions per policy")
+    parser.add_argument('--ticks', type=int, default=TICKS, help="longest session in ticks")
+    parser.add_argument('--size', type=size, default=(World.COLUMNS, World.ROWS), help="map size, e.g. 64x48")
+    parser.add_argument('--seed', type=int, default=0, help="first session seed, the others follow")
+    parser.add_argument('--workers', type=int, help="processes (default one per CPU)")
+    parser.add_argument('--jsonl', metavar='PATH', help="write every session's stats here as it ends")
+    args = parser.parse_args(argv)
+    log.basicConfig(level=log.INFO, format = '%(asctime)s %(message)s')
+
+    out = open(args.jsonl, 'w') if args.jsonl else None
+    done = [0]
+
+    def on_session(session):
+        done[0] += 1
+        if out:
+            out.write(json.dumps(session) + '\n')
+        if done[0] % 100 == 0:
+            log.info("%s sessions done", done[0])
+
+    try:
+        aggregate, seconds = run(args.policy or sorted(POLICIES), args.sessions, args.seed, args.ticks,
+                *args.size, workers=args.workers, on_session=on_session)
+    finally:
+        if out:
+            out.close()
+    total = sum(row['ticks'] for row in aggregate.summary())
+    log.info("%s sessions, %s ticks in %.1f s, %.0f ticks/s over all workers",
+            done[0], total, seconds, total / seconds if seconds else 0.0)
+    print("%-14s %8s %6s %6s %5s %6s %10s" % ('policy', 'sessions', 'deaths', 'depth', 'max', 'level', 'ticks/s'))
+    for row in aggregate.summary():
+        print("%(policy)-14s %(sessions)8d %(death_rate)6.2f %(mean_depth)6.2f %(max_depth)5d "
+              "%(mean_level)6.2f %(ticks_per_second)10.0f" % row)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
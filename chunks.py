@@ -0,0 +1,162 @@
+import logging as log
+import random
+from collections import OrderedDict
+
+from dungeon import VISITED_FLOOR, generate_dungeon
+from engine import Chest, Door, Floor, Hero, Loot, Monster, NoFreeCell, Wall, World
+
+
+VOID = object()  # Blocks like a wall wherever no chunk is loaded
+MONSTER_STATS = ('hp', 'attack', 'defense', 'xp')
+
+
+class ChunkedWorld(World):
+    # Endless level made of CHUNK x CHUNK dungeons streamed in around the hero.
+    # Every chunk is rebuilt from a seed made of the world seed, depth and its
+    # position, so an evicted chunk comes back with the same layout. Its spawns
+    # only come from the seed the first time; after that it gets back what
+    # was still standing in it when it was evicted.
+    CHUNK = 16
+    LOAD_RADIUS = 12  # Cells around the hero that must be loaded
+    MAX_CHUNKS = 16  # Memory budget, least recently used chunks go first
+    DOOR_CHANCE = 0.2
+    depth = 0
+
+    def build_level(self):
+        self.depth += 1
+        self.chunks = OrderedDict()  # (chunk col, chunk row) -> None, oldest first
+        self.left = {}  # Evicted chunk -> [(kind, col, row, image, monster stats)] left in it
+
+        # A chunk's maze grows from its centre, which is always floor
+        half = self.CHUNK // 2
+        cx, cy = self.chunk_of(self.hero.col, self.hero.row)
+        self.hero.col, self.hero.row = cx * self.CHUNK + half, cy * self.CHUNK + half
+        self.stream()
+
+    def chunk_of(self, col, row):
+        return col // self.CHUNK, row // self.CHUNK
+
+    def chunk_rng(self, *key):
+        return random.Random(hash((self.seed, self.depth) + key))
+
+    def check_collision(self, col, row, types=None):
+        if types is None and self.chunk_of(col, row) not in self.chunks:
+            return VOID
+        return super().check_collision(col, row, types)
+
+    def free_cells(self):
+        # The endless level has no fixed free cell index; spawns go in the
+        # hero's chunk, which every other chunk connects to
+        cx, cy = self.chunk_of(self.hero.col, self.hero.row)
+        return [(cx * self.CHUNK + col, cy * self.CHUNK + row)
+                for row in range(1, self.CHUNK-1) for col in range(1, self.CHUNK-1)
+                if not self.check_collision(cx * self.CHUNK + col, cy * self.CHUNK + row)]
+
+    def random_free_cell(self):
+        cells = self.free_cells()
+        if not cells:
+            raise NoFreeCell("Nowhere left to spawn")
+        return self.rng.spawn.choice(cells)
+
+    def spawn(self, kind, count):
+        cells = self.free_cells()
+        return [kind(col, row) for col, row in self.rng.spawn.sample(cells, min(count, len(cells)))]
+
+    def hero_moved(self):
+        super().hero_moved()
+        self.stream()
+
+    def stream(self):
+        col, row = self.hero.col, self.hero.row
+        left, top = self.chunk_of(col - self.LOAD_RADIUS, row - self.LOAD_RADIUS)
+        right, bottom = self.chunk_of(col + self.LOAD_RADIUS, row + self.LOAD_RADIUS)
+        wanted = [(cx, cy) for cy in range(top, bottom + 1) for cx in range(left, right + 1)]
+        for chunk in wanted:
+            if chunk in self.chunks:
+                self.chunks.move_to_end(chunk)
+            else:
+                self.chunks[chunk] = None  # Loaded first, or its own cells would read as VOID
+                self.load_chunk(*chunk)
+
+        keep = max(self.MAX_CHUNKS, len(wanted))
+        while len(self.chunks) > keep:
+            chunk, _ = self.chunks.popitem(last=False)
+            self.evict_chunk(*chunk)
+
+    def chunk_cells(self, cx, cy):
+        size = self.CHUNK
+        dungeon = generate_dungeon(size, size, size // 2, size // 2, self.chunk_rng(cx, cy))
+
+        # Each edge is opened at a spot seeded by the edge itself, so both
+        # chunks sharing it agree. A corridor is carved from the opening
+        # towards the centre until it meets the maze.
+        half = size // 2
+        for key, across in (((cx, cy, 0), True), ((cx + 1, cy, 0), True),
+                            ((cx, cy, 1), False), ((cx, cy + 1, 1), False)):
+            p = self.chunk_rng(*key).randint(1, size-2)
+            if across:
+                col, row = (0 if key[0] == cx else size-1), p
+            else:
+                col, row = p, (0 if key[1] == cy else size-1)
+            while dungeon[col, row] != VISITED_FLOOR:
+                dungeon[col, row] = VISITED_FLOOR
+                if (across and col != half) or row == half:
+                    col += 1 if col < half else -1
+                else:
+                    row += 1 if row < half else -1
+        return dungeon
+
+    def load_chunk(self, cx, cy, spawn=True):
+        log.debug("Load chunk %s %s", cx, cy)
+        dungeon = self.chunk_cells(cx, cy)
+        base_col, base_row = cx * self.CHUNK, cy * self.CHUNK
+        for row in range(self.CHUNK):
+            for col in range(self.CHUNK):
+                if dungeon[col, row] == VISITED_FLOOR:
+                    Floor('ground.png', base_col + col, base_row + row)
+                else:
+                    Wall('wall.png', base_col + col, base_row + row)
+        if not spawn:  # Its monsters and things come from a save instead
+            return
+        left = self.left.pop((cx, cy), None)
+        if left is not None:
+            self.put_back(left)
+            return
+
+        rng = self.chunk_rng(cx, cy, 2)
+        floors = [(base_col + col, base_row + row) for col, row in dungeon.positions(VISITED_FLOOR)]
+        spawns = [Monster] * rng.randint(0, 2) + [Chest] * rng.randint(0, 1)
+        if rng.random() < self.DOOR_CHANCE:
+            spawns.append(Door)
+        for kind in spawns:
+            col, row = rng.choice(floors)
+            if not self.check_collision(col, row):
+                kind(col, row)
+
+    def put_back(self, left):
+        for kind, col, row, image_fname, stats in left:
+            brick = kind(col, row)
+            brick.image_fname = image_fname
+            if stats:
+                for name, value in zip(MONSTER_STATS, stats):
+                    setattr(brick, name, value)
+
+    def evict_chunk(self, cx, cy):
+        log.debug("Evict chunk %s %s", cx, cy)
+        # Whatever wandered in stays with this chunk, whatever was killed,
+        # opened or picked up is not made again
+        left = []
+        base_col, base_row = cx * self.CHUNK, cy * self.CHUNK
+        for row in range(base_row, base_row + self.CHUNK):
+            for col in range(base_col, base_col + self.CHUNK):
+                for brick in self.occupants(col, row):
+                    if isinstance(brick, Hero):
+                        continue
+                    if (isinstance(brick, (Monster, Chest, Door, Loot))
+                            and not getattr(brick, 'in_fight', False) and not getattr(brick, 'is_open', False)):
+                        stats = None
+                        if isinstance(brick, Monster):
+                            stats = tuple(getattr(brick, name) for name in MONSTER_STATS)
+                        left.append((type(brick), brick.col, brick.row, brick.image_fname, stats))
+                    brick.delete()
+        self.left[cx, cy] = left
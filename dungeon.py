@@ -0,0 +1,128 @@
+import random
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+
+UNVISITED, VISITED_FLOOR, VISITED_WALL = range(3)
+NEW_KINDS = (VISITED_FLOOR, VISITED_WALL)
+BITS = tuple(n.bit_length() for n in range(5))  # getrandbits width for randbelow(n)
+
+
+class Dungeon:
+    # One byte per cell, row after row; dungeon[col, row] gives the cell kind
+
+    def __init__(self, width, height, cells=None):
+        self.width = width
+        self.height = height
+        self.cells = cells if cells is not None else bytearray(width * height)
+
+    def __getitem__(self, pos):
+        col, row = pos
+        return self.cells[row * self.width + col]
+
+    def __setitem__(self, pos, kind):
+        col, row = pos
+        self.cells[row * self.width + col] = kind
+
+    def __eq__(self, other):
+        return (isinstance(other, Dungeon) and self.width == other.width
+                and self.cells == other.cells)
+
+    def positions(self, kind):
+        width, cells = self.width, self.cells
+        i = cells.find(kind)
+        while i != -1:
+            yield i % width, i // width
+            i = cells.find(kind, i + 1)
+
+
+def generate_dungeon(width, height, start_col, start_row, rng=random):
+    # Same walk and same random draws as the old list-of-lists version, so a
+    # seed still gives the same layout. shuffle() and choice() are spelled out
+    # with getrandbits() exactly the way Random._randbelow draws them.
+    dungeon = Dungeon(width, height)
+    cells = dungeon.cells
+    cells[:width] = cells[-width:] = bytes([VISITED_WALL]) * width
+    cells[::width] = cells[width-1::width] = bytes([VISITED_WALL]) * height
+
+    getrandbits = rng.getrandbits
+    start = start_row * width + start_col
+    cells[start] = VISITED_FLOOR
+    nodes = [start]
+    pop, push = nodes.pop, nodes.append
+    while nodes:
+        node = pop()
+        unvisited = []
+        floors = walls = 0
+        for neighbour in (node-1, node+1, node-width, node+width):
+            kind = cells[neighbour]
+            if kind == UNVISITED:
+                unvisited.append(neighbour)
+            elif kind == VISITED_FLOOR:
+                floors += 1
+            else:
+                walls += 1
+
+        for i in range(len(unvisited) - 1, 0, -1):  # rng.shuffle(unvisited)
+            bits = BITS[i + 1]
+            j = getrandbits(bits)
+            while j > i:
+                j = getrandbits(bits)
+            unvisited[i], unvisited[j] = unvisited[j], unvisited[i]
+
+        for neighbour in unvisited:
+            if floors < 2:
+                new_kind = VISITED_FLOOR
+            elif not walls:
+                new_kind = VISITED_WALL
+            else:
+                r = getrandbits(2)  # rng.choice(NEW_KINDS)
+                while r > 1:
+                    r = getrandbits(2)
+                new_kind = NEW_KINDS[r]
+
+            cells[neighbour] = new_kind
+            if new_kind == VISITED_FLOOR:
+                floors += 1
+                push(neighbour)
+            else:
+                walls += 1
+
+    return dungeon
+
+
+def label_regions(dungeon):
+    # Numbers the floor cells by the connected region they belong to, 1 and
+    # up, one int per cell row after row; walls get 0. Relies on the border
+    # being wall, like generate_dungeon leaves it.
+    width, cells = dungeon.width, dungeon.cells
+    labels = array('l', bytes(len(cells) * array('l').itemsize))
+    count = 0
+    i = cells.find(VISITED_FLOOR)
+    while i != -1:
+        if not labels[i]:
+            count += 1
+            labels[i] = count
+            stack = [i]
+            pop, push = stack.pop, stack.append
+            while stack:
+                node = pop()
+                for neighbour in (node-1, node+1, node-width, node+width):
+                    if not labels[neighbour] and cells[neighbour] == VISITED_FLOOR:
+                        labels[neighbour] = count
+                        push(neighbour)
+        i = cells.find(VISITED_FLOOR, i + 1)
+    return labels
+
+
+def _generate_seeded(args):
+    seed, width, height, start_col, start_row = args
+    return generate_dungeon(width, height, start_col, start_row, random.Random(seed))
+
+
+def generate_dungeons(seeds, width, height, start_col, start_row, workers=1):
+    jobs = [(seed, width, height, start_col, start_row) for seed in seeds]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            return list(pool.map(_generate_seeded, jobs, chunksize=max(1, len(jobs) // (4 * workers))))
+    return [_generate_seeded(job) for job in jobs]
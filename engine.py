@@ -0,0 +1,1254 @@
+import hashlib
+import heapq
+import logging as log
+import random
+from collections import OrderedDict
+from concurrent.futures import CancelledError
+
+import numpy as np
+
+from dungeon import VISITED_FLOOR, generate_dungeon, label_regions
+
+
+DEBUG = False  # Per step/per brick debug logging, see profiler.configure_logging
+
+# Layers the renderer draws entities in, bottom to top
+BACKGROUND, ON_FLOOR, FOREGROUND = 'background', 'on_floor', 'foreground'
+
+
+class UP: dcol = 0; drow = -1; image_fname = 'hero_up.png'
+class RIGHT: dcol = 1; drow = 0; image_fname = 'hero_right.png'
+class DOWN: dcol = 0; drow = 1; image_fname = 'hero_down.png'
+class LEFT: dcol = -1; drow = 0; image_fname = 'hero_left.png'
+class ACTION: pass
+DIRECTIONS = (UP, RIGHT, DOWN, LEFT)  # Herd and FlowField store an index into this
+
+
+class NoFreeCell(Exception):
+    pass
+
+
+class Clock:
+    # Fixed-timestep scheduler with pyglet.clock's scheduling calls. Callbacks
+    # are bucketed by the tick they are due on, so a tick only touches what
+    # is due then, however many entities are scheduled.
+    TICK = 0.01  # Seconds
+
+    def __init__(self):
+        self.ticks = 0
+        self.time = 0.0
+        self.pending = 0.0  # Time passed but not simulated yet
+        self.buckets = {}  # Tick -> entries due on it
+        self.entries = {}  # Callback -> its live entries
+        self.every_tick = []
+        self.instrument = None  # Wraps callbacks when set, see profiler.Profiler
+
+    def schedule(self, func):
+        self.every_tick.append(func)
+
+    def schedule_interval(self, func, interval):
+        self.add(func, max(1, round(interval / self.TICK)), True)
+
+    def schedule_once(self, func, delay):
+        self.add(func, max(1, round(delay / self.TICK)), False)
+
+    def add(self, func, ticks, repeat):
+        call = func if self.instrument is None else self.instrument(func)
+        entry = [func, ticks, repeat, self.ticks, call]  # ..., tick of the last call, what to run
+        self.entries.setdefault(func, []).append(entry)
+        self.buckets.setdefault(self.ticks + ticks, []).append(entry)
+
+    def unschedule(self, func):
+        for entry in self.entries.pop(func, ()):
+            entry[0] = None  # Left in its bucket, skipped when due
+        if func in self.every_tick:
+            self.every_tick = [f for f in self.every_tick if f != func]
+
+    def step(self):
+        self.ticks += 1
+        self.time = self.ticks * self.TICK
+        for entry in self.buckets.pop(self.ticks, ()):
+            func, ticks, repeat, last, call = entry
+            if func is None:
+                continue
+            if repeat:
+                entry[3] = self.ticks
+                self.buckets.setdefault(self.ticks + ticks, []).append(entry)
+            else:
+                entry[0] = None
+                live = self.entries[func]
+                live.remove(entry)
+                if not live:
+                    del self.entries[func]
+            call((self.ticks - last) * self.TICK)
+        for func in list(self.every_tick):
+            (func if self.instrument is None else self.instrument(func))(self.TICK)
+
+    def tick(self, dt, max_steps=None):
+        # Runs every whole TICK that dt completes; past max_steps the rest
+        # of the backlog is dropped rather than stalling the frame
+        self.pending += dt
+        steps = 0
+        while self.pending >= self.TICK - 1e-9:
+            if max_steps is not None and steps >= max_steps:
+                self.pending = 0.0
+                break
+            self.pending -= self.TICK
+            self.step()
+            steps += 1
+        return steps
+
+
+class Brick:
+    world = None
+    group = FOREGROUND
+    pooled = False  # Deleted ones wait in world.pools for __new__ to hand out again
+    blocks = False  # Takes its cell out of world.free while standing on it
+
+    def __new__(cls, *args, **kwargs):
+        if cls.pooled:
+            pool = cls.world.pools.get(cls)
+            if pool:
+                return pool.pop()  # __init__ then resets it like a new one
+        return super().__new__(cls)
+
+    def __init__(self, image_fname, col=0, row=0, group=None):
+        self.alive = True
+        self._image_fname = image_fname
+        if group is not None:
+            self.group = group
+        elif 'group' in vars(self):
+            del self.group  # Recycled, back to the class layer
+        self.world.bricks.add(self)
+        self._col, self._row = col, row
+        self.world.cells.setdefault((col, row), set()).add(self)
+        self.world.dirty.add(self)
+        if self.blocks:
+            self.world.free.take(col, row)
+
+    @classmethod
+    def staged(cls, image_fname, col, row, bricks, cells):
+        # A brick of a level that is not in the world yet, see LevelBuild
+        brick = cls.__new__(cls)
+        brick.alive = True
+        brick._image_fname = image_fname
+        brick._col, brick._row = col, row
+        bricks.add(brick)
+        cells.setdefault((col, row), set()).add(brick)
+        return brick
+
+    @property
+    def image_fname(self):
+        return self._image_fname
+
+    @image_fname.setter
+    def image_fname(self, v):
+        if v != self._image_fname:
+            self._image_fname = v
+            self.world.dirty.add(self)
+
+    @property
+    def col(self):
+        return self._col
+
+    @col.setter
+    def col(self, v):
+        self.move_cell(v, self._row)
+
+    @property
+    def row(self):
+        return self._row
+
+    @row.setter
+    def row(self, v):
+        self.move_cell(self._col, v)
+
+    def move_cell(self, col, row):
+        self.leave_cell()
+        if self.blocks:
+            self.world.free.move(self._col, self._row, col, row)
+        self._col, self._row = col, row
+        self.world.cells.setdefault((col, row), set()).add(self)
+        self.world.dirty.add(self)
+
+    def leave_cell(self):
+        cell = self.world.cells.get((self._col, self._row))
+        if cell is not None:
+            cell.discard(self)
+            if not cell:
+                del self.world.cells[self._col, self._row]
+
+    def check_collision(self, col, row, types=None):
+        return self.world.check_collision(col, row, types)
+
+    def delete(self):
+        if DEBUG:
+            log.debug("Brick delete, type %s", type(self))
+        self.alive = False
+        self.world.bricks.remove(self)
+        self.leave_cell()
+        if self.blocks:
+            self.world.free.give(self._col, self._row)
+        self.world.dirty.add(self)  # Lets the renderer drop its sprite
+        if self.pooled:
+            self.world.pools.setdefault(type(self), []).append(self)
+
+
+class Wall(Brick):
+    group = BACKGROUND
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.world.walls_version += 1
+
+    def delete(self):
+        self.world.walls_version += 1
+        super().delete()
+
+class Floor(Brick):
+    group = BACKGROUND
+
+
+class Hero(Brick):
+    # Steps only while a key is held: once on the press, then repeating
+    # sooner and sooner down to STEP seconds apart
+    STEP = 0.05
+    FIRST_REPEAT = 0.2
+    ACCELERATION = 0.8
+    blocks = True
+
+    def __init__(self):
+        col = self.world.COLUMNS // 2
+        row = self.world.ROWS // 2
+        self.direction = RIGHT
+        super().__init__(self.direction.image_fname, col, row)
+        log.debug("Draw %s", type (self))
+        self.repeat = self.FIRST_REPEAT
+
+        self.health = 10
+        self.max_health = 10
+        self.potion = 0
+        self.xp = 0
+        self.level = 1
+        self.armor = 0
+        self.max_armor = 10
+        self.sword = 0
+        self.max_sword = 10
+        self.attack = 5 + self.level//2
+        self.defense = 5 + self.level//2
+
+    def armor_limit(self):
+        if self.armor > 10:
+            self.armor = self.max_armor
+
+
+    def sword_limit(self):
+        if self.sword > 10:
+            self.sword = self.max_sword
+
+    def use_potion(self):
+        if self.health < self.max_health:
+            self.amount = self.max_health/3
+            self.health += amount
+            round(self.health)
+            self.potion -= 1
+        elif self.potion <= 0:
+            return
+        elif self.health < self.max_health:
+            return
+
+    def hp_limit(self):
+        if self.health > self.max_health:
+            self.health = self.max_health
+
+    def level_up(self):
+        if self.xp >= self.level**2 * 10:
+            self.level += 1
+            self.max_health += self.level
+            self.health = self.max_health
+
+    def die(self):
+        if self.health <= 0:
+            self.image_fname = 'rip.png'
+            self.world.set_message("Game Over")
+            self.stop_moving()
+
+    def start_moving(self):
+        self.world.clock.unschedule(self.repeat_step)
+        if self.health <= 0:
+            return
+        self.repeat = self.FIRST_REPEAT
+        self.world.clock.schedule_once(self.repeat_step, self.repeat)
+        self.step(0)
+
+    def stop_moving(self):
+        self.world.clock.unschedule(self.repeat_step)
+
+    def repeat_step(self, dt):
+        self.repeat = max(self.STEP, self.repeat * self.ACCELERATION)
+        self.world.clock.schedule_once(self.repeat_step, self.repeat)
+        self.step(dt)
+
+
+    def step(self, dt):
+        keys = self.world.keys
+        want_move = False
+        if UP in keys:
+            self.direction = UP
+            want_move = True
+        elif RIGHT in keys:
+            self.direction = RIGHT
+            want_move = True
+        elif DOWN in keys:
+            self.direction = DOWN
+            want_move = True
+        elif LEFT in keys:
+            self.direction = LEFT
+            want_move = True
+
+        want_action = False
+
+        if ACTION in keys:
+            want_action = True
+        if DEBUG:
+            log.debug('Go %s, action %s', self.direction.__name__ if want_move else None, want_action)
+        if want_move:
+            self.image_fname = self.direction.image_fname
+        if want_action or want_move:
+            col, row = self.col + self.direction.dcol, self.row + self.direction.drow
+            obstacle = self.check_collision(col, row)
+            if not obstacle:
+                if want_move:
+                    self.col, self.row = col, row
+                    self.world.hero_moved()
+                    armor = self.check_collision(col, row, Armor)
+                    if armor:
+                        self.armor += 1
+                        self.armor_limit()
+                        armor.delete()
+                    sword = self.check_collision(col, row, Sword)
+                    if sword:
+                        self.sword += 1
+                        self.sword_limit()
+                        sword.delete()
+            elif isinstance(obstacle, Monster) and want_action:
+                self.fight(obstacle)
+            elif isinstance(obstacle, Chest) and want_action:
+                self.open_chest(obstacle)
+            elif isinstance(obstacle, Door) and want_action:
+                self.open_door(obstacle)
+
+        self.world.set_label_text()
+
+
+    def calc_damage(self, attack, defense):
+        combat = self.world.rng.combat
+        a = int(combat.random() * attack)
+        d = int(combat.random() * defense)
+        return max(0, a-d)
+
+    def fight(self, monster):
+
+        monster.start_fight()
+
+        while monster.hp > 0 and self.health > 0:
+            defense = self.defense + self.armor
+            dmg = self.calc_damage(monster.attack, defense)
+            if dmg > 0:
+                self.health -= dmg
+                if self.health <=0 :
+                    break
+            else:
+                pass
+
+            attack =  self.attack + self.sword
+            dmg = self.calc_damage(attack, monster.defense)
+            if dmg > 0:
+                monster.hp -= dmg
+                if monster.hp < 1:
+                    self.xp += monster.xp
+            else:
+                pass
+
+        self.world.set_label_text()
+        self.level_up()
+        self.die()
+        self.hp_limit
+
+    def open_chest(self, chest):
+        chest.open()
+
+    def open_door(self, door):
+        door.open()
+
+    def delete(self):
+        self.stop_moving()
+        super().delete()
+
+
+def herd_field(name):
+    # Monster attribute kept in its slot of the Herd array of the same name
+    def get(self):
+        return int(getattr(self.world.herd, name)[self.index])
+
+    def set(self, v):
+        getattr(self.world.herd, name)[self.index] = v
+    return property(get, set)
+
+
+class Monster(Brick):
+    STEP = 0.5
+    VISION_RADIUS = 5
+    WAKE_RADIUS = 12  # Cells around the hero where monsters are awake, see Herd
+    SLEEP_MARGIN = 4  # How much further an awake monster gets before it sleeps
+    SLEEP_STEP = None  # Seconds between a sleeping monster's wanders, None keeps it still
+    pooled = True
+    blocks = True
+    # Hero levels strictly between low and high -> (min, max) of HP, DMG, DEF, XP
+    TIERS = [
+        (0, 10, (2, 10), (2, 5), (2, 5), (2, 6)),
+        (10, 20, (8, 15), (5, 10), (5, 10), (6, 10)),
+        (20, 30, (14, 20), (8, 15), (8, 15), (10, 14)),
+        (30, 40, (20, 25), (11, 20), (11, 20), (14, 18)),
+        (40, 50, (26, 30), (14, 25), (14, 25), (18, 22)),
+    ]
+    hp = herd_field('hp')
+    attack = herd_field('attack')
+    defense = herd_field('defense')
+    xp = herd_field('xp')
+
+
+    def __init__(self, col=None, row=None):
+        log.debug('Sprite Monster')
+        if col is None:
+            col, row = self.world.random_free_cell()
+        super().__init__('troll.png')
+        self.world.monsters.add(self)
+        self.in_fight = False
+        # Moves every 0.4 to 0.5 s, see Herd.step
+        self.index = self.world.herd.add(self, self.STEP - 0.1 * self.world.rng.wander.random())
+        self.statistics()
+        self.move_cell(col, row)
+
+
+    def statistics(self):
+        level = self.world.hero.level
+        randint = self.world.rng.stats.randint
+        for low, high, hp, attack, defense, xp in self.TIERS:
+            if low < level < high:
+                self.hp = randint(*hp)
+                self.attack = randint(*attack)
+                self.defense = randint(*defense)
+                self.xp = randint(*xp)
+                break
+
+
+
+    def move_cell(self, col, row):
+        super().move_cell(col, row)
+        herd = self.world.herd
+        herd.col[self.index] = col
+        herd.row[self.index] = row
+
+
+    def start_fight(self):
+        if self.in_fight:
+            return
+        log.debug("Start fight")
+        self.in_fight = True
+        self.world.herd.pause(self.index)
+        self.image_fname = 'blood.png'
+        self.world.clock.schedule_once(self.end_fight, self.STEP)
+
+
+
+    def end_fight(self, dt):
+        log.debug("End fight")
+        self.delete()
+
+
+    def delete(self):
+        self.world.herd.remove(self.index)
+        self.world.clock.unschedule(self.end_fight)
+        self.world.monsters.remove(self)
+        super().delete()
+
+
+class Loot(Brick):
+    # What a chest leaves behind, lying on the floor until picked up
+    group = ON_FLOOR
+    pooled = True
+
+    def __init__(self, image_fname, col, row):
+        super().__init__(image_fname, col, row)
+        self.world.loot.add(self)
+
+    def delete(self):
+        self.world.loot.remove(self)
+        super().delete()
+
+
+class Armor(Loot):
+
+    def __init__(self, col, row):
+        file_name = self.world.rng.loot.choice(['armor_left.png', 'armor_right.png', 'helmet_left.png',
+                'helmet_right.png', 'legarmor_left.png', 'legarmor_right.png', 'boot_right.png',
+                'boot_left.png', 'shield_left.png', 'shield_right.png'])
+        super().__init__(file_name, col, row)
+
+class Sword(Loot):
+
+    def __init__(self,col, row):
+        file_name = self.world.rng.loot.choice(['sword_piece_one.png','sword_piece_two.png','sword_piece_three.png'])
+        super().__init__(file_name, col, row)
+
+
+class Chest(Brick):
+    STEP = 0.9
+    pooled = True
+    blocks = True
+
+    def __init__(self, col=None, row=None):
+        if col is None:
+            col, row = self.world.random_free_cell()
+        super().__init__('chest_close.png')
+        self.world.chests.add(self)
+        self.is_open = False
+        self.col = col
+        self.row = row
+
+    def open(self):
+        if self.is_open:
+            return
+        self.is_open = True
+        self.image_fname = 'chest_open.png'
+        self.world.clock.schedule_once(self.end_opening, self.STEP)
+
+    def end_opening(self, dt):
+        self.world.rng.loot.choice ([Armor,Sword])(self.col, self.row)
+        self.delete()
+
+
+    def delete(self):
+        self.world.clock.unschedule(self.end_opening)
+        self.world.chests.remove(self)
+        super().delete()
+
+
+class Door(Brick):
+    STEP = 0.9
+    pooled = True
+    blocks = True
+
+    def __init__(self, col=None, row=None):
+        if col is None:
+            col, row = self.world.random_free_cell()
+        super().__init__('trapdoor_close.png')
+        self.world.doors.add(self)
+        self.is_open = False
+        self.col = col
+        self.row = row
+
+    def open(self):
+        if self.is_open:
+            return
+        self.is_open = True
+        self.image_fname = 'trapdoor_open.png'
+        self.world.clock.schedule_once(self.end_opening, self.STEP)
+
+    def end_opening(self, dt):
+        self.delete()
+        hero = self.world.hero
+        hero.col, hero.row = self.col, self.row  # Down through the trapdoor
+        self.world.start_level()
+
+
+    def delete(self):
+        self.world.clock.unschedule(self.end_opening)
+        self.world.doors.remove(self)
+        super().delete()
+
+
+class FreeCells:
+    # Floor cells of the hero's region that nothing blocks, as col + row *
+    # width in a list for O(1) random picks, plus each one's place in the
+    # list so taking one out is O(1) too. Bricks that block take and give
+    # back their cell as they come, move and go.
+
+    def __init__(self, world):
+        self.world = world
+        self.width = 0
+        self.region = bytearray()  # 1 where a spawn may go, by col + row * width
+        self.cells = []
+        self.slots = {}  # Cell -> its index in cells
+
+    def reset(self, region=None):
+        # region: bool array [row, col] of the cells spawns may use
+        self.width = region.shape[1] if region is not None else 0
+        self.region = bytearray(region.tobytes()) if region is not None else bytearray()
+        self.cells = np.flatnonzero(region).tolist() if region is not None else []
+        self.slots = dict(zip(self.cells, range(len(self.cells))))
+        world = self.world
+        for brick in [world.hero, *world.monsters, *world.chests, *world.doors]:
+            if brick is not None and brick.alive:
+                self.take(brick.col, brick.row)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def take(self, col, row):
+        slot = self.slots.pop(col + row * self.width, None)
+        if slot is not None:
+            self.drop(slot)
+
+    def give(self, col, row):
+        # Nothing else that blocks ever shares a cell, so the one leaving frees it
+        pos = col + row * self.width
+        if self.width and 0 <= pos < len(self.region) and self.region[pos] and pos not in self.slots:
+            self.slots[pos] = len(self.cells)
+            self.cells.append(pos)
+
+    def move(self, old_col, old_row, col, row):
+        # take() and give() in one, the cell left goes in where the new one was
+        if not self.width or (old_col, old_row) == (col, row):
+            return
+        slots = self.slots
+        slot = slots.pop(col + row * self.width, None)
+        old = old_col + old_row * self.width
+        if slot is None:
+            self.give(old_col, old_row)
+        elif self.region[old] and old not in slots:
+            self.cells[slot] = old
+            slots[old] = slot
+        else:
+            self.drop(slot)
+
+    def drop(self, slot):
+        last = self.cells.pop()
+        if slot < len(self.cells):
+            self.cells[slot] = last
+            self.slots[last] = slot
+
+    def choice(self, rng):
+        if not self.cells:
+            return None
+        pos = self.cells[rng.randrange(len(self.cells))]
+        return pos % self.width, pos // self.width
+
+    def sample(self, count, rng):
+        # Up to count distinct cells
+        picked = rng.sample(self.cells, min(count, len(self.cells)))
+        return [(pos % self.width, pos // self.width) for pos in picked]
+
+
+class FlowField:
+    # Breadth-first search out from the hero over floor cells. Every monster
+    # reads its next step from the same field, which is only rebuilt once
+    # the hero has moved or a wall has changed.
+    RADIUS = 12  # Steps searched out from the hero
+
+    def __init__(self, world):
+        self.world = world
+        self.key = None
+        # Index into DIRECTIONS of the step that leads one step closer, by
+        # offset from the hero: steps[drow + RADIUS, dcol + RADIUS]; -1 if none
+        self.steps = None
+
+    def steps_from(self, dcol, drow):
+        # Arrays of offsets from the hero in, DIRECTIONS indices out
+        hero = self.world.hero
+        key = hero.col, hero.row, self.world.walls_version
+        if key != self.key:
+            self.key = key
+            self.build(hero.col, hero.row)
+        return self.steps[drow + self.RADIUS, dcol + self.RADIUS]
+
+    def build(self, col, row):
+        check = self.world.check_collision
+        radius = self.RADIUS
+        steps = np.full((2 * radius + 1, 2 * radius + 1), -1, np.int8)
+        seen = {(col, row)}
+        frontier = [(col, row)]
+        for distance in range(radius):
+            reached = []
+            for c, r in frontier:
+                for i, direction in enumerate(DIRECTIONS):
+                    cell = c - direction.dcol, r - direction.drow
+                    if cell not in seen and check(cell[0], cell[1], Floor):
+                        seen.add(cell)
+                        steps[cell[1] - row + radius, cell[0] - col + radius] = i
+                        reached.append(cell)
+            frontier = reached
+        self.steps = steps
+
+
+class FieldOfView:
+    # What can be seen from a cell, by recursive shadowcasting over the walls
+    # around it. One result per (origin, radius) is kept until the walls
+    # change, so the hero's view is worked out once per move and shared by
+    # the fog of war and every monster checking whether it sees the hero.
+    # Views are cast at least as far as radius and smaller ones cut out of
+    # that, so asking at several radii still casts once.
+    CACHE = 64  # Results kept, least recently used go first
+    # Per octant, how its (dx, dy) map to columns and rows: col += dx*xx + dy*xy, row += dx*yx + dy*yy
+    OCTANTS = ((1, 0, 0, -1), (0, 1, -1, 0), (0, -1, -1, 0), (-1, 0, 0, -1),
+               (-1, 0, 0, 1), (0, -1, 1, 0), (0, 1, 1, 0), (1, 0, 0, 1))
+    radius = 0  # gra.Game casts at its FOG_RADIUS
+
+    def __init__(self, world):
+        self.world = world
+        self.walls_version = None
+        self.cache = OrderedDict()  # (col, row, radius) -> bool array, see cached()
+
+    def cached(self, col, row, radius):
+        if self.walls_version != self.world.walls_version:
+            self.walls_version = self.world.walls_version
+            self.cache.clear()
+        key = col, row, radius
+        seen = self.cache.get(key)
+        if seen is None:
+            seen = self.cache[key] = self.cast(col, row, radius)
+            if len(self.cache) > self.CACHE:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return seen
+
+    def visible(self, col, row, radius):
+        # Cells seen from (col, row) within radius, as a bool array by
+        # offset: visible[drow + radius, dcol + radius]
+        cast = max(radius, self.radius)
+        seen = self.cached(col, row, cast)
+        if cast == radius:
+            return seen
+        crop = seen[cast - radius:cast + radius + 1, cast - radius:cast + radius + 1]
+        drow, dcol = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+        return crop & (dcol * dcol + drow * drow <= radius * radius)
+
+    def sees(self, col, row, radius, dcol, drow):
+        # Arrays of offsets within radius in, whether (col, row) sees them out
+        cast = max(radius, self.radius)
+        seen = self.cached(col, row, cast)[drow + cast, dcol + cast]
+        return seen & (dcol * dcol + drow * drow <= radius * radius)
+
+    def clear_cells(self, col, row, radius):
+        # The cells around (col, row) that do not block the view, row after row
+        size = 2 * radius + 1
+        floor = self.world.floor
+        if floor is None:
+            check = self.world.check_collision
+            return bytes(not check(c, r, Wall) for r in range(row - radius, row + radius + 1)
+                         for c in range(col - radius, col + radius + 1))
+        window = np.zeros((size, size), bool)  # Past the edges counts as wall
+        height, width = floor.shape
+        top, bottom = max(0, row - radius), min(height, row + radius + 1)
+        left, right = max(0, col - radius), min(width, col + radius + 1)
+        window[top - row + radius:bottom - row + radius, left - col + radius:right - col + radius] = \
+                floor[top:bottom, left:right]
+        return window.tobytes()
+
+    def cast(self, col, row, radius):
+        size = 2 * radius + 1
+        clear = self.clear_cells(col, row, radius)
+        lit = bytearray(size * size)
+        lit[radius * size + radius] = 1
+        radius2 = radius * radius
+
+        def scan(distance, start, end, xx, xy, yx, yy):
+            # Lights one octant from distance out, between the start and end
+            # slopes, and recurses into the gaps a wall leaves open
+            if start < end:
+                return
+            for j in range(distance, radius + 1):
+                dy = -j
+                blocked = False
+                new_start = start
+                for dx in range(-j, 1):
+                    left, right = (dx - 0.5) / (dy + 0.5), (dx + 0.5) / (dy - 0.5)
+                    if start < right:
+                        continue
+                    if end > left:
+                        break
+                    i = (radius + dx * yx + dy * yy) * size + radius + dx * xx + dy * xy
+                    if dx * dx + dy * dy <= radius2:
+                        lit[i] = 1
+                    if blocked:
+                        if not clear[i]:
+                            new_start = right
+                        else:
+                            blocked = False
+                            start = new_start
+                    elif not clear[i] and j < radius:
+                        blocked = True
+                        scan(j + 1, start, left, xx, xy, yx, yy)
+                        new_start = right
+                if blocked:
+                    break
+
+        for octant in self.OCTANTS:
+            scan(1, 1.0, 0.0, *octant)
+        return np.frombuffer(bytes(lit), bool).reshape(size, size)
+
+
+class Herd:
+    # Every monster's position, stats and move timer in flat arrays, one slot
+    # per monster. Slots are bucketed by the tick they are due on, like
+    # Clock.buckets; each tick one vectorized pass over its bucket works out
+    # where they head, only the moves themselves go through the bricks.
+    # Monsters further than Monster.WAKE_RADIUS from the hero fall asleep and
+    # only wander every SLEEP_STEP, if at all, until the hero comes near.
+    # Sleepers are filed by BLOCK, so waking them looks at the blocks around
+    # the hero only.
+    GROW = 256
+    BLOCK = 16  # Cells per side of a block of sleepers
+    IDLE = np.iinfo(np.int64).max  # next_tick of free slots, fighting and still sleeping monsters
+    FIELDS = ('col', 'row', 'hp', 'attack', 'defense', 'xp', 'next_tick', 'period', 'used', 'asleep',
+              'block_col', 'block_row')
+    DCOL = np.array([direction.dcol for direction in DIRECTIONS])
+    DROW = np.array([direction.drow for direction in DIRECTIONS])
+
+    def __init__(self, world):
+        self.world = world
+        self.rng = np.random.default_rng(world.rng.wander.getrandbits(64))
+        self.monsters = []  # Slot -> Monster, None when free
+        self.free = []  # Heap of free slots; the lowest goes first, whatever order they were freed in
+        self.buckets = {}  # Tick -> slots due on it; those since rescheduled are skipped when due
+        self.sleeping = {}  # Block (col // BLOCK, row // BLOCK) -> slots of the sleepers in it
+        for name in self.FIELDS:
+            setattr(self, name, np.zeros(0, np.int64))
+        world.clock.schedule(self.step)
+
+    def add(self, monster, interval):
+        if not self.free:
+            size = len(self.monsters)
+            for name in self.FIELDS:
+                setattr(self, name, np.resize(getattr(self, name), size + self.GROW))
+            self.next_tick[size:] = self.IDLE
+            self.used[size:] = 0
+            self.asleep[size:] = 0
+            self.monsters.extend([None] * self.GROW)
+            self.free.extend(range(size, size + self.GROW))  # All above the rest, still a heap
+        slot = heapq.heappop(self.free)
+        self.monsters[slot] = monster
+        self.used[slot] = 1
+        self.col[slot], self.row[slot] = monster._col, monster._row
+        self.hp[slot] = self.attack[slot] = self.defense[slot] = self.xp[slot] = 0
+        self.period[slot] = max(1, round(interval / self.world.clock.TICK))
+        self.schedule(slot, self.world.clock.ticks + int(self.period[slot]))
+        return slot
+
+    def schedule(self, slot, tick):
+        self.next_tick[slot] = tick
+        self.buckets.setdefault(tick, []).append(slot)
+
+    def pause(self, slot):
+        self.rouse(slot)
+        self.next_tick[slot] = self.IDLE
+
+    def remove(self, slot):
+        self.monsters[slot] = None
+        self.used[slot] = 0
+        self.rouse(slot)
+        self.next_tick[slot] = self.IDLE
+        heapq.heappush(self.free, slot)
+
+    def sleep(self, slot):
+        # Files the slot under the block it is in now
+        block = int(self.col[slot]) // self.BLOCK, int(self.row[slot]) // self.BLOCK
+        self.block_col[slot], self.block_row[slot] = block
+        self.sleeping.setdefault(block, set()).add(slot)
+        self.asleep[slot] = 1
+
+    def rouse(self, slot):
+        if not self.asleep[slot]:
+            return
+        block = int(self.block_col[slot]), int(self.block_row[slot])
+        sleepers = self.sleeping[block]
+        sleepers.discard(slot)
+        if not sleepers:
+            del self.sleeping[block]
+        self.asleep[slot] = 0
+
+    def wake(self, col, row):
+        # Wakes the sleepers within Monster.WAKE_RADIUS of the cell, due at
+        # once like the hero had just come in sight
+        if not self.sleeping:
+            return
+        radius = Monster.WAKE_RADIUS
+        tick = self.world.clock.ticks + 1
+        for block_row in range((row - radius) // self.BLOCK, (row + radius) // self.BLOCK + 1):
+            for block_col in range((col - radius) // self.BLOCK, (col + radius) // self.BLOCK + 1):
+                for slot in list(self.sleeping.get((block_col, block_row), ())):
+                    dcol, drow = int(self.col[slot]) - col, int(self.row[slot]) - row
+                    if dcol * dcol + drow * drow <= radius * radius:
+                        self.rouse(slot)
+                        self.schedule(slot, tick)
+
+    def step(self, dt):
+        ticks = self.world.clock.ticks
+        due = self.buckets.pop(ticks, None)
+        if due is None:
+            return
+        due = np.unique(due)  # In slot order, like a replay expects
+        due = due[self.next_tick[due] == ticks]
+        if not due.size:
+            return
+        hero = self.world.hero
+        dcol = self.col[due] - hero.col
+        drow = self.row[due] - hero.row
+        distance2 = dcol * dcol + drow * drow
+
+        # Out of the wake radius they fall asleep, a little further out so one
+        # on the edge does not flip every step. A sleeper wakes a cell before
+        # the radius, so its wander can not take it inside still asleep.
+        was_asleep = self.asleep[due] != 0
+        asleep = np.where(was_asleep, distance2 > (Monster.WAKE_RADIUS + 1) ** 2,
+                distance2 > (Monster.WAKE_RADIUS + Monster.SLEEP_MARGIN) ** 2)
+        for slot in due[was_asleep & ~asleep].tolist():
+            self.rouse(slot)
+        sleepers = due[asleep]  # Filed after their wander
+        if Monster.SLEEP_STEP is None:
+            next_ticks = np.where(asleep, self.IDLE, ticks + self.period[due])
+        else:
+            sleep = max(1, round(Monster.SLEEP_STEP / self.world.clock.TICK))
+            next_ticks = ticks + np.where(asleep, sleep, self.period[due])
+        self.next_tick[due] = next_ticks
+        buckets = self.buckets
+        for slot, tick in zip(due.tolist(), next_ticks.tolist()):
+            if tick != self.IDLE:
+                buckets.setdefault(tick, []).append(slot)
+
+        moving = distance2 > 0
+        due, dcol, drow, distance2 = due[moving], dcol[moving], drow[moving], distance2[moving]
+
+        # Out of sight they wander, in sight they follow the flow field, and
+        # where it has no way round the walls they just close in
+        direction = self.rng.integers(4, size=due.size)
+        radius = Monster.VISION_RADIUS
+        near = np.flatnonzero(distance2 < radius ** 2)
+        if near.size:  # Seen from the hero's side, so it is the view the fog shows
+            near = near[self.world.fov.sees(hero.col, hero.row, radius, dcol[near], drow[near])]
+        if near.size:
+            chase = self.world.flow.steps_from(dcol[near], drow[near]).astype(np.int64)
+            stuck = chase < 0
+            if stuck.any():
+                closer = ((dcol[near][stuck, None] + self.DCOL) ** 2
+                          + (drow[near][stuck, None] + self.DROW) ** 2)
+                chase[stuck] = closer.argmin(axis=1)
+            direction[near] = chase
+
+        cols = self.col[due] + self.DCOL[direction]
+        rows = self.row[due] + self.DROW[direction]
+        floor = self.world.floor
+        if floor is not None:  # Walls are ruled out here, the rest brick by brick
+            open_ = floor[rows, cols]
+            due, cols, rows = due[open_], cols[open_], rows[open_]
+
+        check = self.world.check_collision
+        monsters = self.monsters
+        for slot, col, row in zip(due.tolist(), cols.tolist(), rows.tolist()):
+            if not check(col, row):
+                monsters[slot].move_cell(col, row)
+        # Only those falling asleep or wandering into another block are filed again
+        block_cols = self.col[sleepers] // self.BLOCK
+        block_rows = self.row[sleepers] // self.BLOCK
+        refile = ((self.asleep[sleepers] == 0) | (self.block_col[sleepers] != block_cols)
+                  | (self.block_row[sleepers] != block_rows))
+        sleepers, block_cols, block_rows = sleepers[refile], block_cols[refile], block_rows[refile]
+        for slot in sleepers[self.asleep[sleepers] != 0].tolist():
+            self.rouse(slot)
+        self.block_col[sleepers], self.block_row[sleepers] = block_cols, block_rows
+        self.asleep[sleepers] = 1
+        sleeping = self.sleeping
+        for slot, block in zip(sleepers.tolist(), zip(block_cols.tolist(), block_rows.tolist())):
+            sleeping.setdefault(block, set()).add(slot)
+
+
+def spawn_region(dungeon, col, row):
+    # The floor cells connected to (col, row), as a bool array [row, col]
+    labels = np.frombuffer(label_regions(dungeon), 'l').reshape(dungeon.height, dungeon.width)
+    label = labels[row, col]
+    if not label:  # Not on a floor, anywhere on the floor will do
+        return labels > 0
+    return labels == label
+
+
+def plan_level(seed, columns, rows, start_col, start_row):
+    # Everything random about a new level, worked out apart from the world so
+    # it can run on a worker process: the dungeon, the region the hero can
+    # walk to and where things spawn in it
+    rng = random.Random(seed)
+    dungeon = generate_dungeon(columns, rows, start_col, start_row, rng)
+    region = spawn_region(dungeon, start_col, start_row)
+    kinds = ['Door'] + ['Chest'] * rng.randint(1, 3) + ['Monster'] * rng.randint(3, 9)
+    start = start_col + start_row * columns
+    free = [pos for pos in np.flatnonzero(region).tolist() if pos != start]
+    cells = rng.sample(free, min(len(kinds), len(free)))
+    return dungeon, region, [(kind, pos % columns, pos // columns) for kind, pos in zip(kinds, cells)]
+
+
+def stage_tiles(dungeon, bricks, cells):
+    # Makes a dungeon's Floor and Wall bricks into bricks/cells, one per next()
+    for row in range(dungeon.height):
+        for col in range(dungeon.width):
+            if dungeon[col, row] == VISITED_FLOOR:
+                yield Floor.staged('ground.png', col, row, bricks, cells)
+            else:
+                yield Wall.staged('wall.png', col, row, bricks, cells)
+
+
+class LevelBuild:
+    # The next level, made while the current one is played. The plan comes
+    # from World.planner, then the Floor and Wall bricks are made a budget at
+    # a time into sets of their own, so going down only swaps them in.
+
+    def __init__(self, world, start, seed):
+        self.start = start
+        self.args = (seed, world.COLUMNS, world.ROWS) + start
+        self.future = None
+        if world.planner:
+            try:
+                self.future = world.planner.submit(plan_level, *self.args)
+            except RuntimeError as e:  # A broken or shut down pool
+                log.warning("Planning the next level in place: %s", e)
+        self.plan = None
+        self.bricks = set()
+        self.cells = {}
+        self.tiles = None
+        self.done = False
+
+    def step(self, budget=None):
+        # Makes up to budget bricks, all of what is left with None
+        if self.plan is None:
+            if self.future is None:
+                self.plan = plan_level(*self.args)
+            elif budget is not None and not self.future.done():
+                return
+            else:
+                try:
+                    self.plan = self.future.result()
+                except (RuntimeError, CancelledError) as e:  # The planner died, the plan is the same made here
+                    log.warning("Planning the next level in place: %s", e)
+                    self.plan = plan_level(*self.args)
+            self.tiles = stage_tiles(self.plan[0], self.bricks, self.cells)
+        made = 0
+        for brick in self.tiles:
+            made += 1
+            if budget is not None and made >= budget:
+                return
+        self.done = True
+
+
+class RandomStreams:
+    # One seeded random.Random per subsystem, so that for instance an extra
+    # combat roll does not change the next dungeon
+    NAMES = ('dungeon', 'spawn', 'stats', 'wander', 'combat', 'loot')
+
+    def __init__(self, seed):
+        for name in self.NAMES:
+            setattr(self, name, random.Random('%s:%s' % (seed, name)))
+
+
+class World:
+    # Game rules without any window; gra.Game adds the pyglet rendering on top
+    COLUMNS = 32
+    ROWS = 18
+    planner = None  # Executor planning the next level, None plans it in place
+    STAGE_BUDGET = 5000  # Bricks of the next level made per advance()
+
+    def __init__(self, seed=None):
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.rng = RandomStreams(self.seed)
+        self.journal = None  # Input log while recording, see replay.Recorder
+        self.clock = Clock()
+        self.bricks = set()
+        self.dirty = set()
+        self.cells = {}  # (col, row) -> set of bricks standing on that cell
+        self.walls_version = 0  # Bumped whenever a Wall comes or goes
+        self.flow = FlowField(self)
+        self.fov = FieldOfView(self)
+        self.herd = Herd(self)
+        self.floor = None  # Level's floor cells as a bool array [row, col], if it has fixed bounds
+        self.free = FreeCells(self)
+        self.monsters = set()
+        self.chests = set()
+        self.doors = set()
+        self.loot = set()  # Armor and Sword lying about
+        self.keys = set()  # Held UP/RIGHT/DOWN/LEFT/ACTION, see press()
+        self.message = 'Press R to Start'
+        self.hero = None
+        self.next_level = None  # LevelBuild for the level under the trapdoor
+        self.pools = {}  # Brick class -> deleted pooled bricks, see Brick.__new__
+        Brick.world = self  # Set up globally used world object
+
+    def check_collision(self, col, row, types=None):
+        if types is None:
+            types = (Wall, Monster, Hero, Chest, Door)
+
+        for brick in self.cells.get((col, row), ()):
+            if isinstance(brick, types):
+                return brick
+        else:
+            return  # No collision, return None
+
+    def occupants(self, col, row, types=None):
+        cell = self.cells.get((col, row), ())
+        if types is None:
+            return list(cell)
+        return [brick for brick in cell if isinstance(brick, types)]
+
+    def random_free_cell(self):
+        cell = self.free.choice(self.rng.spawn)
+        if cell is None:
+            raise NoFreeCell("Nowhere left to spawn")
+        return cell
+
+    def spawn(self, kind, count):
+        # Up to count of kind at once, each on a free cell of its own
+        return [kind(col, row) for col, row in self.free.sample(count, self.rng.spawn)]
+
+    def restart(self):
+        if self.journal is not None:
+            self.journal.append((self.clock.ticks, 'restart', None))
+        self.start_game()
+        self.start_level()
+
+    def start_game(self):
+        if self.hero:
+            self.hero.delete()
+        self.hero = Hero()
+
+    def start_level(self):
+        self.clear_level()
+        self.build_level()
+        self.set_message("")
+        self.set_label_text()
+
+    def clear_level(self):
+        # Everything but the hero goes. Only the few bricks with timers or
+        # sprites are deleted one by one, the floors and walls are dropped
+        # with the sets holding them.
+        self.free.reset()
+        for brick in [brick for brick in self.bricks if not isinstance(brick, (Floor, Wall, Hero))]:
+            brick.delete()
+        self.dirty = {brick for brick in self.dirty if not isinstance(brick, (Floor, Wall))}
+        self.bricks = set()
+        self.cells = {}
+        self.walls_version += 1
+        if self.hero:
+            self.bricks.add(self.hero)
+            self.cells[self.hero.col, self.hero.row] = {self.hero}
+
+    def build_level(self):
+        start = (self.hero.col, self.hero.row)
+        build, self.next_level = self.next_level, None
+        if build is None or build.start != start:
+            build = LevelBuild(self, start, self.rng.dungeon.getrandbits(32))
+        if not build.done:
+            build.step()
+        dungeon, region, spawns = build.plan
+        self.enter_level(dungeon, build.bricks, build.cells, region)
+        log.debug("Built %sx%s level", self.COLUMNS, self.ROWS)
+
+        kinds = {'Monster': Monster, 'Chest': Chest, 'Door': Door}
+        for kind, col, row in spawns:
+            kinds[kind](col, row)
+            if kind == 'Door':
+                self.next_level = LevelBuild(self, (col, row), self.rng.dungeon.getrandbits(32))
+
+    def enter_level(self, dungeon, bricks, cells, region=None):
+        # Swaps in the floors and walls staged for dungeon, keeping whatever
+        # is in the world already. Spawns go in region, by default the part
+        # of the dungeon the hero stands in.
+        bricks.update(self.bricks)
+        for pos, cell in self.cells.items():
+            cells.setdefault(pos, set()).update(cell)
+        self.bricks, self.cells = bricks, cells
+        self.dirty.update(bricks)
+        self.floor = np.frombuffer(dungeon.cells, np.uint8).reshape(
+                dungeon.height, dungeon.width) == VISITED_FLOOR
+        if region is None:
+            region = spawn_region(dungeon, self.hero.col, self.hero.row)
+        self.free.reset(region)
+
+    def hero_moved(self):
+        self.herd.wake(self.hero.col, self.hero.row)
+
+    def press(self, action):
+        if self.journal is not None:
+            self.journal.append((self.clock.ticks, 'press', action.__name__))
+        self.keys.add(action)
+        if self.hero:
+            self.hero.start_moving()
+
+    def release(self, action):
+        if self.journal is not None:
+            self.journal.append((self.clock.ticks, 'release', action.__name__))
+        self.keys.discard(action)
+        if self.hero and not self.keys:
+            self.hero.stop_moving()
+
+    def set_message(self, text):
+        self.message = text
+
+    def state_hash(self):
+        hero = self.hero
+        state = [self.clock.ticks, self.walls_version]
+        if hero:
+            state.append((hero.col, hero.row, hero.health, hero.max_health, hero.xp,
+                    hero.level, hero.armor, hero.sword, hero.potion))
+        state.extend(sorted((type(brick).__name__, brick.col, brick.row, getattr(brick, 'hp', 0))
+                for brick in self.bricks if not isinstance(brick, (Floor, Wall))))
+        return hashlib.sha1(repr(state).encode()).hexdigest()
+
+    def set_label_text(self):
+        pass
+
+    def advance(self, dt, max_steps=None):
+        steps = self.clock.tick(dt, max_steps)
+        if self.next_level and not self.next_level.done:
+            self.next_level.step(self.STAGE_BUDGET)
+        return steps
+
+    def update(self, dt):
+        self.advance(dt)
+        self.dirty.clear()  # Nobody draws a headless world
+
+
+def random_walk(seconds=1.0, profile=False):
+    # Headless smoke run: a hero wandering at random for up to `seconds`
+    import time
+
+    from profiler import Profiler
+
+    world = World()
+    profiler = Profiler(world)
+    if profile:
+        profiler.enable()
+    world.restart()
+    ticks = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds and world.hero.health > 0:
+        if ticks % 50 == 0:
+            for action in list(world.keys):
+                world.release(action)
+            world.press(ACTION)
+            world.press(random.choice([UP, RIGHT, DOWN, LEFT]))
+        world.update(Clock.TICK)
+        if profiler.enabled:
+            profiler.end_frame()
+        ticks += 1
+    log.info("%s ticks in %.2f s, hero level %s",
+            ticks, time.perf_counter() - started, world.hero.level)
+    if profiler.enabled:
+        log.info("Per tick, last %s ticks:\n%s", len(profiler.frames), profiler.report(len(profiler.frames)))
+
+
+if __name__ == "__main__":
+    import sys
+
+    import engine  # The classes profiler instruments, not this script's copies
+    from profiler import configure_logging
+
+    configure_logging('--debug' in sys.argv)
+    engine.random_walk(profile='--profile' in sys.argv)
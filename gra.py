@@ -1,475 +1,320 @@
+import base64
 import logging as log
-import math
-import random
+import multiprocessing
+import string
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pyglet
+
+if __name__ == '__mp_main__':
+    # This script run again in the spawned level planner, which must not
+    # open a display or GL context of its own
+    pyglet.options['shadow_window'] = False
 import pyglet.graphics
 import pyglet.resource
+from pyglet.gl import (GL_NEAREST, GL_QUADS, GL_SCISSOR_TEST, glDisable, glEnable, glPopMatrix,
+        glPushMatrix, glScalef, glScissor, glTranslatef)
 from pyglet.window import key
 
+from assets import Atlas
+from chunks import ChunkedWorld
+from profiler import Profiler, configure_logging
+from replay import Recorder
+from savegame import Saver, load, loads, restore
+from engine import (ACTION, BACKGROUND, DOWN, FOREGROUND, LEFT, ON_FLOOR, RIGHT, UP,
+        Chest, Door, Floor, Hero, Loot, Monster, Wall, World)
+
+
+class Camera(pyglet.graphics.OrderedGroup):
+    # Everything on the map is laid out in cell units, a brick at (col, row)
+    # covering x col..col+1 and y -row-1..-row. This maps them to window
+    # pixels and clips them to the map area, so zooming, scrolling or
+    # resizing is one matrix and no sprite is touched.
+    def __init__(self, order, parent=None):
+        super().__init__(order, parent)
+        self.x = self.y = 0
+        self.scale = 1
+        self.clip = (0, 0, 1, 1)
+
+    def set_state(self):
+        glEnable(GL_SCISSOR_TEST)
+        glScissor(*self.clip)
+        glPushMatrix()
+        glTranslatef(self.x, self.y, 0)
+        glScalef(self.scale, self.scale, 1)
+
+    def unset_state(self):
+        glPopMatrix()
+        glDisable(GL_SCISSOR_TEST)
+
 
 # Used to order sprites
 back_image = pyglet.graphics.OrderedGroup(0)
-background = pyglet.graphics.OrderedGroup(1)
-on_floor = pyglet.graphics.OrderedGroup(2)
-foreground = pyglet.graphics.OrderedGroup(3)
-hud = pyglet.graphics.OrderedGroup(4)
-
-
-log.basicConfig(level=log.DEBUG, format = '%(asctime)s %(message)s')
-
-class Brick(pyglet.sprite.Sprite):
-    bricks = set()
-    dirty = set()
-    game = None
-
-    def __init__(self, image, col=0, row=0, group=foreground):
-        super().__init__(image, batch=self.game.batch, group=group)
-        self.bricks.add(self)
-        self.col, self.row = col, row
-
-    @property
-    def col(self):
-        return self._col
-
-    @col.setter
-    def col(self, v):
-        self._col = v
-        self.dirty.add(self)
-
-    @property
-    def row(self):
-        return self._row
-
-    @row.setter
-    def row(self, v):
-        self._row = v
-        self.dirty.add(self)
-
-    def place(self):
-        self.scale = self.game.brick_scale
-        self.x = self.game.base_x + self.col * self.game.brick_px
-        self.y = self.game.base_y - (self.row + 1) * self.game.brick_px  # +1 because of anchor point
-
-    def delete(self):
-        log.debug("Brick delete, type %s", type(self))
-        self.dirty.discard(self)
-        self.bricks.remove(self)
-        super().delete()
-
-    @classmethod
-    def check_collision(cls, col, row, types=None):
-        if types is None:
-            types = (Wall, Monster, Hero, Chest, Door)
-
-        for brick in cls.bricks:
-            if col == brick.col and row == brick.row and isinstance(brick, types):
-                return brick
-        else:
-            return  # No collision, return None
-
-
-class Wall(Brick):
-    pass
-class Floor(Brick):
-    pass
-
-class UP: dcol = 0; drow = -1; image_fname = 'hero_up.png'
-class RIGHT: dcol = 1; drow = 0; image_fname = 'hero_right.png'
-class DOWN: dcol = 0; drow = 1; image_fname = 'hero_down.png'
-class LEFT: dcol = -1; drow = 0; image_fname = 'hero_left.png'
-
-class Hero(Brick):
-    STEP = 0.01
-
-    def __init__(self):
-        col = self.game.COLUMNS // 2
-        row = self.game.ROWS // 2
-        self.direction = RIGHT
-        super().__init__(pyglet.resource.image(self.direction.image_fname), col, row)
-        log.debug("Draw %s", type (self))
-        pyglet.clock.schedule_interval(self.step, self.STEP)
-        
-        self.health = 10
-        self.max_health = 10
-        self.potion = 0
-        self.xp = 0
-        self.level = 1
-        self.armor = 0
-        self.max_armor = 10
-        self.sword = 0
-        self.max_sword = 10
-        self.attack = 5 + self.level//2
-        self.defense = 5 + self.level//2
-
-    def armor_limit(self):
-        if self.armor > 10:
-            self.armor = self.max_armor
-
-
-    def sword_limit(self):
-        if self.sword > 10:
-            self.sword = self.max_sword
-
-    def use_potion(self):
-        if self.health < self.max_health:
-            self.amount = self.max_health/3
-            self.health += amount
-            round(self.health)
-            self.potion -= 1
-        elif self.potion <= 0:
-            return
-        elif self.health < self.max_health:
+camera = Camera(1)
+background = pyglet.graphics.OrderedGroup(0, parent=camera)
+on_floor = pyglet.graphics.OrderedGroup(1, parent=camera)
+foreground = pyglet.graphics.OrderedGroup(2, parent=camera)
+hud = pyglet.graphics.OrderedGroup(2)
+
+
+groups = {BACKGROUND: background, ON_FLOOR: on_floor, FOREGROUND: foreground}
+actions = {key.UP: UP, key.RIGHT: RIGHT, key.DOWN: DOWN, key.LEFT: LEFT, key.SPACE: ACTION}
+zoom_keys = {key.EQUAL: 2, key.PLUS: 2, key.NUM_ADD: 2, key.MINUS: 0.5, key.NUM_SUBTRACT: 0.5}
+
+
+class TileLayer:
+    # Draws the static Floor/Wall cells as one vertex list per BLOCK x BLOCK
+    # cells, all from the atlas texture, instead of a sprite per cell
+    BLOCK = 16
+
+    def __init__(self, batch, parent, atlas):
+        self.batch = batch
+        self.regions = atlas.regions
+        self.group = pyglet.graphics.TextureGroup(atlas.texture, parent=parent)
+        self.blocks = {}  # (block col, block row) -> [vertex list, indices of set cells]
+
+    def set(self, col, row, fname, shade=255):
+        size = self.BLOCK
+        key = col // size, row // size
+        block = self.blocks.get(key)
+        if block is None:
+            if fname is None:
+                return
+            vertex_list = self.batch.add(4 * size * size, GL_QUADS, self.group,
+                    ('v2f/dynamic', [0.0] * 8 * size * size),
+                    ('t3f/dynamic', [0.0] * 12 * size * size),
+                    ('c3B/dynamic', [255] * 12 * size * size))
+            block = self.blocks[key] = [vertex_list, set()]
+
+        vertex_list, filled = block
+        i = (row % size) * size + col % size
+        if fname is None:
+            vertex_list.vertices[i*8:i*8+8] = [0.0] * 8  # Degenerate quad
+            filled.discard(i)
+            if not filled:
+                vertex_list.delete()
+                del self.blocks[key]
             return
 
-    def hp_limit(self):
-        if self.health > self.max_health:
-            self.health = self.max_health
-   
-    def level_up(self):
-        if self.xp >= self.level**2 * 10:
-            self.level += 1
-            self.max_health += self.level
-            self.health = self.max_health
-    
-    def die(self):
-        if self.health <= 0:
-            self.image = pyglet.resource.image('rip.png')
-            self.game.label.text = "Game Over"
-            pyglet.clock.unschedule(self.step)          
-
-
-    def step(self, dt):
-        want_move = False
-        if self.game.keys[key.UP]:
-            self.direction = UP
-            log.debug('Go Up')
-            want_move = True
-        elif self.game.keys[key.RIGHT]:
-            self.direction = RIGHT
-            log.debug('Go Right')
-            want_move = True
-        elif self.game.keys[key.DOWN]:
-            self.direction = DOWN
-            log.debug('Go Down')
-            want_move = True
-        elif self.game.keys[key.LEFT]:
-            self.direction = LEFT
-            log.debug('Go Left')
-            want_move = True
-
-        want_action = False
-        
-        if self.game.keys[key.SPACE]:
-            log.debug('Start Action')
-            want_action = True
-        if want_move:
-            self.image = pyglet.resource.image(self.direction.image_fname)
-        if want_action or want_move:
-            col, row = self.col + self.direction.dcol, self.row + self.direction.drow
-            obstacle = self.check_collision(col, row)
-            if not obstacle:
-                if want_move:
-                    self.col, self.row = col, row
-                    armor = self.check_collision(col, row, Armor)
-                    if armor:
-                        self.armor += 1
-                        self.armor_limit()
-                        armor.delete()
-                    sword = self.check_collision(col, row, Sword)
-                    if sword:
-                        self.sword += 1
-                        self.sword_limit()
-                        sword.delete()
-            elif isinstance(obstacle, Monster) and want_action:
-                self.fight(obstacle)
-            elif isinstance(obstacle, Chest) and want_action:
-                self.open_chest(obstacle)
-            elif isinstance(obstacle, Door) and want_action:
-                self.open_door(obstacle)
-                
-        self.game.set_label_text()
-        
-        
-    def calc_damage(self, attack, defense):
-        a = int(random.random() * attack)
-        d = int(random.random() * defense)
-        return max(0, a-d)      
-        
-    def fight(self, monster):  
-    
-        monster.start_fight()
-        
-        while monster.hp > 0 and self.health > 0:
-            defense = self.defense + self.armor
-            dmg = self.calc_damage(monster.attack, defense)
-            if dmg > 0:
-                self.health -= dmg
-                if self.health <=0 :
-                    break
-            else:
-                pass
-
-            attack =  self.attack + self.sword
-            dmg = self.calc_damage(attack, monster.defense)
-            if dmg > 0:
-                monster.hp -= dmg
-                if monster.hp < 1:
-                    self.xp += monster.xp
-            else:
-                pass
-        
-        self.game.set_label_text()
-        self.level_up()
-        self.die()
-        self.hp_limit
-        
-    def open_chest(self, chest):
-        chest.open()
-        
-    def open_door(self, door):
-        door.open()    
-    
-    def delete(self):
-        pyglet.clock.unschedule(self.step)
-        super().delete()
-        
-
-class Monster(Brick):
-    STEP = 0.5
-    VISION_RADIUS = 5
-    monsters = set()
-
-
-    def __init__(self):
-        self.monster_image = pyglet.resource.image('troll.png')
-        log.debug('Sprite Monster')
-        super().__init__(self.monster_image)
-        self.monsters.add(self)
-        self.in_fight = False
-        self.statistics()
-        
-        while True:
-            col = random.randint(1, self.game.COLUMNS-2)
-            row = random.randint(1, self.game.ROWS-2)
-            if not self.check_collision(col, row):
-                break
-        self.col = col
-        self.row = row
-
-        pyglet.clock.schedule_interval(self.move, self.STEP - 0.1 * random.random())
-
-
-    def statistics(self):
-        if self.game.hero.level > 0 and self.game.hero.level < 10:
-            self.hp = random.randint(2,10)       # HP
-            self.attack = random.randint(2,5)     # DMG
-            self.defense = random.randint(2,5)     # DEF
-            self.xp = random.randint(2,6)           # XP
-        elif self.game.hero.level > 10 and self.game.hero.level < 20:
-            self.hp = random.randint(8,15)       # HP
-            self.attack = random.randint(5,10)    # DMG
-            self.defense = random.randint(5,10)    # DEF
-            self.xp = random.randint(6,10)          # XP
-        elif self.game.hero.level > 20 and self.game.hero.level < 30:
-            self.hp = random.randint(14,20)      # HP
-            self.attack = random.randint(8,15)    # DMG
-            self.defense = random.randint(8,15)    # DEF
-            self.xp = random.randint(10,14)         # XP
-        elif self.game.hero.level > 30 and self.game.hero.level < 40:
-            self.hp = random.randint(20,25)      # HP
-            self.attack = random.randint(11,20)   # DMG
-            self.defense = random.randint(11,20)   # DEF
-            self.xp = random.randint(14,18)         # XP
-        elif self.game.hero.level > 40 and self.game.hero.level < 50:
-            self.hp = random.randint(26,30)      # HP
-            self.attack = random.randint(14,25)   # DMG
-            self.defense = random.randint(14,25)   # DEF
-            self.xp = random.randint(18,22)         # XP
-
-
-
-    def move(self, dt):
-        current_distance = math.hypot(self.col - self.game.hero.col, self.row - self.game.hero.row)
-
-        if current_distance == 0:
+        x, y = col, -row - 1
+        vertex_list.vertices[i*8:i*8+8] = [x, y, x+1, y, x+1, y+1, x, y+1]
+        vertex_list.tex_coords[i*12:i*12+12] = self.regions[fname].tex_coords
+        vertex_list.colors[i*12:i*12+12] = [shade] * 12
+        filled.add(i)
+
+    def shade(self, col, row, shade):
+        # Darkens a set cell, 0 black to 255 as drawn
+        size = self.BLOCK
+        block = self.blocks.get((col // size, row // size))
+        if block is not None:
+            vertex_list, filled = block
+            i = (row % size) * size + col % size
+            if i in filled:
+                vertex_list.colors[i*12:i*12+12] = [shade] * 12
+
+    def clear(self):
+        for vertex_list, filled in self.blocks.values():
+            vertex_list.delete()
+        self.blocks = {}
+
+
+class Minimap:
+    # The level at one texel per cell, in a texture of its own drawn as one
+    # HUD sprite. Floors and walls come straight from world.floor; after that
+    # only touch()ed cells are coloured again, and only the BLOCK x BLOCK
+    # squares holding them are uploaded.
+    BLOCK = 32
+    SIZE = 160  # Pixels its longer side is drawn at
+    MARGIN = 10
+    UNSEEN = (0, 0, 0, 0)
+    FLOOR = (110, 95, 80, 220)
+    WALL = (35, 30, 30, 220)
+    COLORS = ((Hero, (255, 255, 255, 255)), (Monster, (220, 40, 40, 255)), (Door, (80, 160, 255, 255)),
+              (Chest, (240, 200, 40, 255)), (Loot, (60, 220, 90, 255)))  # First one found wins
+
+    def __init__(self, game, batch, group):
+        self.game = game
+        self.batch, self.group = batch, group
+        self.texture = None
+        self.sprite = None
+        self.pixels = None  # [y, x] texels, y counted from the bottom like GL does
+        self.touched = set()
+        self.shown = True
+
+    def reset(self):
+        # Everything again for a new level; an endless one gets no minimap
+        game = self.game
+        self.touched.clear()
+        if game.floor is None:
+            if self.sprite:
+                self.sprite.delete()
+            self.texture = self.sprite = self.pixels = None
             return
-        elif current_distance < self.VISION_RADIUS:
-            best_direction = None
-            best_distance = 99999
-            for direction in (UP, RIGHT, DOWN, LEFT):
-                distance = self.get_step_distance(direction)
-                if distance < best_distance:
-                    best_distance = distance
-                    best_direction = direction
+        rows, cols = game.floor.shape
+        if game.FOG:
+            self.pixels = np.zeros((rows, cols, 4), np.uint8)  # All UNSEEN
         else:
-            best_direction = random.choice([UP, RIGHT, DOWN, LEFT])
+            self.pixels = np.where(game.floor[::-1, :, None], self.FLOOR, self.WALL).astype(np.uint8)
+        if self.texture is None or (self.texture.width, self.texture.height) != (cols, rows):
+            self.texture = pyglet.image.Texture.create(cols, rows, min_filter=GL_NEAREST, mag_filter=GL_NEAREST)
+            if self.sprite:
+                self.sprite.image = self.texture
+            else:
+                self.sprite = pyglet.sprite.Sprite(self.texture, batch=self.batch, group=self.group)
+            self.sprite.visible = self.shown
+            self.place(game.width, game.height)
+        self.upload(0, 0, cols, rows)
+        for brick in [game.hero, *game.monsters, *game.chests, *game.doors, *game.loot]:
+            self.touch(brick.col, brick.row)
+
+    def place(self, width, height):
+        if self.sprite:
+            self.sprite.scale = self.SIZE / max(self.texture.width, self.texture.height)
+            self.sprite.position = (width - self.sprite.width - self.MARGIN,
+                                    height - self.sprite.height - self.MARGIN)
+
+    def toggle(self):
+        self.shown = not self.shown
+        if self.sprite:
+            self.sprite.visible = self.shown
+
+    def touch(self, col, row):
+        self.touched.add((col, row))
+
+    def flush(self):
+        # Once a frame: recolours the touched cells and uploads their blocks
+        touched, self.touched = self.touched, set()
+        if self.pixels is None or not touched:
+            return
+        rows, cols = self.pixels.shape[:2]
+        blocks = set()
+        for col, row in touched:
+            if 0 <= col < cols and 0 <= row < rows:
+                y = rows - 1 - row
+                self.pixels[y, col] = self.color(col, row)
+                blocks.add((col // self.BLOCK * self.BLOCK, y // self.BLOCK * self.BLOCK))
+        for x, y in blocks:
+            self.upload(x, y, min(self.BLOCK, cols - x), min(self.BLOCK, rows - y))
+
+    def upload(self, x, y, width, height):
+        data = self.pixels[y:y + height, x:x + width].tobytes()
+        self.texture.blit_into(pyglet.image.ImageData(width, height, 'RGBA', data), x, y, 0)
+
+    def color(self, col, row):
+        game = self.game
+        pos = col, row
+        if game.FOG and pos not in game.seen:
+            return self.UNSEEN
+        shown = [brick for brick in game.cells.get(pos, ()) if game.shows(brick)]
+        for kind, color in self.COLORS:
+            if any(isinstance(brick, kind) for brick in shown):
+                return color
+        return self.FLOOR if game.floor[row, col] else self.WALL
+
+
+class GlyphText:
+    # Stands in for a HUD Label. Its characters are rendered to glyphs once,
+    # so new text only swaps and moves a few sprites instead of running a
+    # full text layout.
+    CHARS = string.ascii_uppercase + string.digits + ' :/-'
+
+    def __init__(self, text, font_name, font_size, color, anchor_x, anchor_y, batch, group):
+        font = pyglet.font.load(font_name, font_size)
+        self.glyphs = dict(zip(self.CHARS, font.get_glyphs(self.CHARS)))
+        self.ascent, self.descent = font.ascent, font.descent
+        self.color = color
+        self.anchor_x, self.anchor_y = anchor_x, anchor_y
+        self.batch, self.group = batch, group
+        self.sprites = []
+        self._x = self._y = 0
+        self._text = None
+        self.text = text
 
-        new_col = self.col + best_direction.dcol
-        new_row = self.row + best_direction.drow
-        if not self.check_collision(new_col, new_row):
-            self.col = new_col
-            self.row = new_row
+    @property
+    def text(self):
+        return self._text
 
+    @text.setter
+    def text(self, v):
+        if v != self._text:
+            self._text = v
+            self.layout()
 
-    def get_step_distance(self, direction):
-        col, row = self.col + direction.dcol, self.row + direction.drow
-        return math.hypot(col - self.game.hero.col, row - self.game.hero.row)
+    @property
+    def x(self):
+        return self._x
 
+    @x.setter
+    def x(self, v):
+        self._x = v
+        self.layout()
 
-    def start_fight(self):
-        if self.in_fight:
-            return
-        log.debug("Start fight")
-        self.in_fight = True
-        pyglet.clock.unschedule(self.move)
-        self.image = pyglet.resource.image('blood.png')
-        pyglet.clock.schedule_once(self.end_fight, self.STEP)
-
-
-
-    def end_fight(self, dt):
-        log.debug("End fight")
-        self.delete()
-
-
-    def delete(self):
-        pyglet.clock.unschedule(self.move)
-        pyglet.clock.unschedule(self.end_fight)
-        self.monsters.remove(self)
-        super().delete()
-
-class Armor(Brick):
-    def __init__(self, col, row):
-        file_name = random.choice(['armor_left.png', 'armor_right.png', 'helmet_left.png', 
-                'helmet_right.png', 'legarmor_left.png', 'legarmor_right.png', 'boot_right.png',
-                'boot_left.png', 'shield_left.png', 'shield_right.png'])
-        super().__init__(pyglet.resource.image(file_name), col, row, group=on_floor)
-        
-class Sword(Brick):
-    def __init__(self,col, row):
-        file_name = random.choice(['sword_piece_one.png','sword_piece_two.png','sword_piece_three.png'])
-        super().__init__(pyglet.resource.image(file_name), col, row, group=on_floor)
-
-class Chest(Brick):
-    STEP = 0.9
-    chests = set()
-    
-    def __init__(self):
-        self.chest_image = pyglet.resource.image('chest_close.png')
-        super().__init__(self.chest_image)
-        self.chests.add(self)
-        self.is_open = False
-    
-        while True:
-            col = random.randint(1, self.game.COLUMNS-2)
-            row = random.randint(1, self.game.ROWS-2)
-            if not self.check_collision(col, row):
-                break
-        self.col = col
-        self.row = row
-    
-    def open(self):
-        if self.is_open:
-            return
-        self.is_open = True
-        self.image = pyglet.resource.image('chest_open.png')
-        pyglet.clock.schedule_once(self.end_opening, self.STEP)
-        
-    def end_opening(self, dt):
-        random.choice ([Armor,Sword])(self.col, self.row)
-        self.delete()
-        
-    
-    def delete(self):
-        pyglet.clock.unschedule(self.end_opening)
-        self.chests.remove(self)
-        super().delete()
-        
-class Door(Brick):
-    STEP = 0.9
-    doors = set()
-    
-    def __init__(self):
-        self.door_image = pyglet.resource.image('trapdoor_close.png')
-        super().__init__(self.door_image)
-        self.doors.add(self)
-        self.is_open = False
-    
-        while True:
-            col = random.randint(1, self.game.COLUMNS-2)
-            row = random.randint(1, self.game.ROWS-2)
-            if not self.check_collision(col, row):
-                break
-        self.col = col
-        self.row = row
-        
-    def open(self):
-        if self.is_open:
-            return
-        self.is_open = True
-        self.image = pyglet.resource.image('trapdoor_open.png')
-        pyglet.clock.schedule_once(self.end_opening, self.STEP)
-    
-    def end_opening(self, dt):
-        self.delete()
-        self.game.start_level()
-        
-    
-    def delete(self):
-        pyglet.clock.unschedule(self.end_opening)
-        self.doors.remove(self)
-        super().delete()
-
-UNVISITED, VISITED_FLOOR, VISITED_WALL = range(3)
-def generate_dungeon(width, height, start_col, start_row):
-    dungeon = [[UNVISITED for row in range(height)] for col in range(width)]
-    for row in range(height):
-        for col in range(width):
-            if (row == 0 or col == 0
-                    or row == height-1 or col == width-1):
-                dungeon[col][row] = VISITED_WALL
-
-    dungeon[start_col][start_row] = VISITED_FLOOR
-    nodes = [(start_col, start_row)]
-    while nodes:
-        node = col, row = nodes.pop()
-        neighbours = [(col-1, row), (col+1, row), (col, row-1), (col, row+1)]
-        kinds = {UNVISITED: [], VISITED_FLOOR: [], VISITED_WALL: []}
-        for neighbour in neighbours:
-            ncol, nrow = neighbour
-            kinds[dungeon[ncol][nrow]].append(neighbour)
-        
-        random.shuffle(kinds[UNVISITED])
-        for unvisited in kinds[UNVISITED]:
-            ucol, urow = unvisited
-            if len(kinds[VISITED_FLOOR]) < 2:
-                new_kind = VISITED_FLOOR
-            elif not kinds[VISITED_WALL]:
-                new_kind = VISITED_WALL
-            else:
-                new_kind = random.choice([VISITED_FLOOR, VISITED_WALL])
-
-            dungeon[ucol][urow] = new_kind
-            kinds[new_kind].append(unvisited)
-            if new_kind == VISITED_FLOOR:
-                nodes.append(unvisited)
-                
-    return dungeon
-        
-    
-class Game(pyglet.window.Window):
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, v):
+        self._y = v
+        self.layout()
+
+    def layout(self):
+        glyphs = [self.glyphs[c] for c in self._text if c in self.glyphs]
+        while len(self.sprites) > len(glyphs):
+            self.sprites.pop().delete()
+        while len(self.sprites) < len(glyphs):
+            sprite = pyglet.sprite.Sprite(glyphs[len(self.sprites)], batch=self.batch, group=self.group)
+            sprite.color = self.color[:3]
+            sprite.opacity = self.color[3]
+            self.sprites.append(sprite)
+
+        width = sum(glyph.advance for glyph in glyphs)
+        x = self._x - {'left': 0, 'center': width / 2, 'right': width}[self.anchor_x]
+        baseline = self._y - {'top': self.ascent, 'center': (self.ascent + self.descent) / 2,
+                'bottom': self.descent, 'baseline': 0}[self.anchor_y]
+        for sprite, glyph in zip(self.sprites, glyphs):
+            if sprite.image is not glyph:
+                sprite.image = glyph
+            sprite.position = (x + glyph.vertices[0], baseline + glyph.vertices[1])
+            x += glyph.advance
+
+
+class Game(World, pyglet.window.Window):
     STEP = 0.3  # Seconds
-    COLUMNS = 32
-    ROWS = 18
     HUD_HEIGHT = 50
-
-    def __init__(self):
-        super().__init__(resizable=True)
+    MAX_STEPS = 10  # Simulation ticks per frame at most, a longer stall is dropped
+    PLACE_BUDGET = 20000  # Bricks placed per frame at most, the rest wait a frame
+    SAVE_FILE = 'save.bin'
+    AUTOSAVE = 60  # Seconds
+    HUD_GLYPHS = False  # Draw the HUD stats with GlyphText instead of Labels
+    SCROLL_MARGIN = 4  # Cells the hero keeps from the view's edge before it scrolls
+    MAX_ZOOM = 8
+    view_col = view_row = 0  # World cell shown in the top left corner
+    zoom = 1  # The view shows COLUMNS / zoom x ROWS / zoom cells
+    FOG = True  # Only what the hero sees is lit; seen before is dim, the rest dark
+    FOG_RADIUS = 8
+    SEEN_SHADE = 90
+
+    def __init__(self, seed=None, visible=True):
+        pyglet.window.Window.__init__(self, resizable=True, visible=visible)
+        World.__init__(self, seed)
+        self.fov.radius = self.FOG_RADIUS  # One cast per move for the fog and the monsters
+        # Spawned, not forked, so the worker does not share the window's X
+        # connection and GL context; see the shadow window above
+        self.planner = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
         pyglet.clock.set_fps_limit(60)
+        pyglet.clock.schedule(self.update)
         self.batch = pyglet.graphics.Batch()
-        self.keys = key.KeyStateHandler()
-        self.push_handlers(self.keys)
+        self.sprites = {}  # Brick -> the sprite drawing it
+        self.spare_sprites = {}  # Group -> hidden sprites of dead bricks, to reuse
+        self.atlas = Atlas()
+        self.images = self.atlas.regions
+        self.tiles = TileLayer(self.batch, background, self.atlas)
+        self.tile_bricks = {}  # (col, row) -> the Floor or Wall drawn there
+        self.lit = set()  # Cells the hero sees now, with FOG
+        self.seen = set()  # Cells the hero has seen on this level, with FOG
         self.score = 0
 
         self.label = pyglet.text.Label(
@@ -477,94 +322,63 @@ class Game(pyglet.window.Window):
                 color=(255, 0, 0, 255),
                 anchor_x='center', anchor_y='center',
                 batch=self.batch, group=hud)
-        self.level_label = pyglet.text.Label(
-                '', 'Times New Roman', 10,
-                color=(255, 255, 0, 255),
-                anchor_x='right', anchor_y='bottom',
-                batch=self.batch, group=hud)
-        self.xp_label = pyglet.text.Label(
-                '', 'Times New Roman', 10,
-                color=(255, 255, 0, 255),
-                anchor_x='right', anchor_y='top',
-                batch=self.batch, group=hud)
-        self.health_label = pyglet.text.Label(
-                '', 'Times New Roman', 10,
-                color=(255, 255, 0, 255),
-                anchor_x='center', anchor_y='bottom',
-                batch=self.batch, group=hud)
-        self.potion_label = pyglet.text.Label(
-                '', 'Times New Roman', 10,
-                color=(255, 255, 0, 255),
-                anchor_x='center', anchor_y='top',
-                batch=self.batch, group=hud)
-        self.armor_label = pyglet.text.Label(
-                '', 'Times New Roman', 10,
-                color=(255, 255, 0, 255),
-                anchor_x='right', anchor_y='bottom',
-                batch=self.batch, group=hud)
-        self.sword_label = pyglet.text.Label(
-                '', 'Times New Roman', 10,
-                color=(255, 255, 0, 255),
-                anchor_x='right', anchor_y='top',
+        self.level_label = self.hud_label('right', 'bottom')
+        self.xp_label = self.hud_label('right', 'top')
+        self.health_label = self.hud_label('center', 'bottom')
+        self.potion_label = self.hud_label('center', 'top')
+        self.armor_label = self.hud_label('right', 'bottom')
+        self.sword_label = self.hud_label('right', 'top')
+        self.hud_stats = None
+
+        self.profiler = Profiler(self)
+        self.saver = Saver(self, self.SAVE_FILE)
+        pyglet.clock.schedule_interval(self.autosave, self.AUTOSAVE)
+        self.profile_label = pyglet.text.Label(
+                '', 'Courier New', 9,
+                color=(255, 255, 255, 255),
+                anchor_x='left', anchor_y='top',
+                multiline=True, width=400,
                 batch=self.batch, group=hud)
 
         self.back_image = pyglet.resource.image('background.png')
         self.back = pyglet.sprite.Sprite(
                 self.back_image, batch=self.batch, group=back_image)
 
-        self.ground_image = pyglet.resource.image('ground.png')
-        self.brick_image = pyglet.resource.image('wall.png')
-        Brick.game = self  # Set up globally used game object
-        
-        self.hero = None
+        self.brick_image = self.images['wall.png']
+        self.minimap = Minimap(self, self.batch, hud)
+        self.cell_scale = 1 / self.brick_image.width  # Sprites are one cell wide, see Camera
+        self.on_resize(self.width, self.height)  # A hidden window gets no resize event
 
 
-    def start_game(self):
+    def hud_label(self, anchor_x, anchor_y):
+        kind = GlyphText if self.HUD_GLYPHS else pyglet.text.Label
+        return kind('', 'Times New Roman', 10,
+                color=(255, 255, 0, 255),
+                anchor_x=anchor_x, anchor_y=anchor_y,
+                batch=self.batch, group=hud)
 
-        if self.hero:
-            self.hero.delete()
-        self.hero = Hero()
-       
-        
-    def start_level(self):
-        for brick in list(Brick.bricks):
-            if not isinstance(brick, Hero):
-                brick.delete()
-    
-        dungeon = generate_dungeon(self.COLUMNS, self.ROWS, self.hero.col, self.hero.row)
-    
-        for row in range(self.ROWS):
-            for col in range(self.COLUMNS):
-                if dungeon[col][row] == VISITED_FLOOR:
-                    log.debug("Floor")
-                    Floor(self.ground_image, col, row, group=background)
-                else:
-                    log.debug("Wall")
-                    Wall(self.brick_image, col, row, group=background)
-       
-        for x in range(random.randint(3,9)):
-            Monster()
-            
-        for x in range(random.randint(1,3)):
-            Chest()
-
-        for x in range(1):
-            Door()       
-        
-        pyglet.clock.unschedule(self.update)
-        pyglet.clock.tick()
-        pyglet.clock.schedule(func=self.update)
-        self.label.text = ""
-        self.time = 0.0
-        self.set_label_text()
+    def set_message(self, text):
+        super().set_message(text)
+        self.label.text = text
 
     def set_label_text(self):
-        self.level_label.text = "LEVEL: %s" % (self.hero.level)
-        self.xp_label.text = "XP: %s / %s" % (self.hero.xp, self.hero.level**2 * 10 - self.hero.xp)
-        self.health_label.text = "HP: %s / %s" % (self.hero.health, self.hero.max_health)
-        self.potion_label.text = "POTIONS: %s" % (self.hero.potion)
-        self.sword_label.text = "SWORD PIECES: %s / %s" % (self.hero.sword, self.hero.max_sword)
-        self.armor_label.text = "ARMOR PIECES: %s / %s" % (self.hero.armor, self.hero.max_armor)
+        hero = self.hero
+        stats = (hero.level, hero.xp, hero.health, hero.max_health, hero.potion,
+                hero.sword, hero.max_sword, hero.armor, hero.max_armor)
+        if stats == self.hud_stats:
+            return
+        self.hud_stats = stats
+
+        # Setting a label's text lays it out again, so only touch changed ones
+        for label, text in (
+                (self.level_label, "LEVEL: %s" % (hero.level)),
+                (self.xp_label, "XP: %s / %s" % (hero.xp, hero.level**2 * 10 - hero.xp)),
+                (self.health_label, "HP: %s / %s" % (hero.health, hero.max_health)),
+                (self.potion_label, "POTIONS: %s" % (hero.potion)),
+                (self.sword_label, "SWORD PIECES: %s / %s" % (hero.sword, hero.max_sword)),
+                (self.armor_label, "ARMOR PIECES: %s / %s" % (hero.armor, hero.max_armor))):
+            if label.text != text:
+                label.text = text
 
     def set_score(self, v):
         self.score = v
@@ -577,13 +391,15 @@ class Game(pyglet.window.Window):
                 width / self.back_image.width, height / self.back_image.height)
 
         self.brick_px = min(width / self.COLUMNS, (height - self.HUD_HEIGHT) / self.ROWS)
-        self.brick_scale = self.brick_px / self.brick_image.width
         self.base_x = (width - self.brick_px * self.COLUMNS) / 2
         self.base_y = height - (height - self.brick_px * self.ROWS + self.HUD_HEIGHT) / 2
 
         self.label.x = self.width // 2
         self.label.y = self.height // 2
 
+        self.profile_label.x = 10
+        self.profile_label.y = self.height - 10
+
         self.level_label.x = self.width // 6
         self.level_label.y = self.base_y + self.HUD_HEIGHT // 2
 
@@ -602,30 +418,227 @@ class Game(pyglet.window.Window):
         self.armor_label.x = self.width // 1.1
         self.armor_label.y = self.base_y + self.HUD_HEIGHT // 2
 
-        Brick.dirty |= Brick.bricks
+        self.place_camera()
+        self.minimap.place(width, height)
+
 
+    def place_camera(self):
+        px = self.brick_px * self.zoom
+        camera.scale = px
+        camera.x = self.base_x - self.view_col * px
+        camera.y = self.base_y + self.view_row * px
+        camera.clip = (int(self.base_x), int(self.base_y - self.ROWS * self.brick_px),
+                int(self.COLUMNS * self.brick_px), int(self.ROWS * self.brick_px))
+
+    def follow_hero(self, recentre=False):
+        cols, rows = self.COLUMNS // self.zoom, self.ROWS // self.zoom
+        col = self.hero.col - self.view_col
+        row = self.hero.row - self.view_row
+        margin = min(self.SCROLL_MARGIN, cols // 4, rows // 4)
+        if not recentre and margin <= col < cols - margin and margin <= row < rows - margin:
+            return
+        self.view_col, self.view_row = self.clamp_view(
+                self.hero.col - cols // 2, self.hero.row - rows // 2, cols, rows)
+        self.place_camera()
+
+    def clamp_view(self, col, row, cols, rows):
+        # A level with fixed bounds is never scrolled past its edges
+        return (min(max(col, 0), self.COLUMNS - cols), min(max(row, 0), self.ROWS - rows))
+
+    def set_zoom(self, zoom):
+        self.zoom = int(min(max(zoom, 1), self.MAX_ZOOM))
+        if self.hero:
+            self.follow_hero(recentre=True)
+        else:
+            self.place_camera()
+
+    def update_fog(self):
+        # Only the cells going in or out of view are shaded again
+        if not self.FOG:
+            return
+        hero, radius = self.hero, self.FOG_RADIUS
+        rows, cols = np.nonzero(self.fov.visible(hero.col, hero.row, radius))
+        lit = set(zip((cols + hero.col - radius).tolist(), (rows + hero.row - radius).tolist()))
+        changed = lit ^ self.lit
+        self.lit = lit
+        self.seen |= lit
+        for pos in changed:
+            self.tiles.shade(pos[0], pos[1], self.shade(pos))
+            self.minimap.touch(*pos)
+            for brick in self.cells.get(pos, ()):
+                if not isinstance(brick, (Floor, Wall)):
+                    self.dirty.add(brick)
+
+    def shade(self, pos):
+        if not self.FOG or pos in self.lit:
+            return 255
+        return self.SEEN_SHADE if pos in self.seen else 0
+
+    def shows(self, brick):
+        # Monsters are only shown in view, things stay where last seen
+        pos = brick.col, brick.row
+        return (not self.FOG or brick is self.hero or pos in self.lit
+                or (pos in self.seen and not isinstance(brick, Monster)))
 
     def on_draw(self):
         self.clear()
-        while Brick.dirty:
-            brick = Brick.dirty.pop()
-            brick.place()
-        self.batch.draw()
+        if not self.profiler.enabled:
+            self.place_dirty()
+            self.minimap.flush()
+            self.batch.draw()
+            return
+
+        profiler = self.profiler
+        profiler.count('placed bricks', len(self.dirty))
+        with profiler.section('place'):
+            self.place_dirty()
+        with profiler.section('minimap'):
+            self.minimap.flush()
+        with profiler.section('batch.draw'):
+            self.batch.draw()
+        profiler.end_frame()
+        if profiler.frame_count % 30 == 0:
+            self.profile_label.text = profiler.report()
+
+    def place_dirty(self):
+        dirty = self.dirty
+        for i in range(min(len(dirty), self.PLACE_BUDGET)):
+            self.place(dirty.pop())
+
+    def clear_level(self):
+        super().clear_level()
+        self.tiles.clear()
+        self.tile_bricks.clear()
+        self.lit = set()
+        self.seen = set()
+
+    def enter_level(self, dungeon, bricks, cells, region=None):
+        super().enter_level(dungeon, bricks, cells, region)
+        self.minimap.reset()
+
+    def place(self, brick):
+        if isinstance(brick, (Floor, Wall)):
+            self.place_tile(brick)
+            return
+
+        sprite = self.sprites.get(brick)
+        if sprite is not None:  # Where it was, see Camera
+            self.minimap.touch(round(sprite.x), round(-sprite.y - 1))
+        self.minimap.touch(brick.col, brick.row)
+        if not brick.alive:
+            if sprite is not None:
+                del self.sprites[brick]
+                sprite.visible = False  # Kept for the next brick in its layer
+                self.spare_sprites.setdefault(sprite.group, []).append(sprite)
+            return
+
+        if sprite is None:
+            group = groups[brick.group]
+            spare = self.spare_sprites.get(group)
+            if spare:
+                sprite = self.sprites[brick] = spare.pop()
+                sprite.image = self.images[brick.image_fname]
+            else:
+                sprite = self.sprites[brick] = pyglet.sprite.Sprite(
+                        self.images[brick.image_fname], batch=self.batch, group=group,
+                        subpixel=True)  # Cell units, the camera scales them up
+                sprite.scale = self.cell_scale
+            sprite.image_fname = brick.image_fname
+        elif sprite.image_fname != brick.image_fname:
+            sprite.image = self.images[brick.image_fname]
+            sprite.image_fname = brick.image_fname
+        sprite.position = (brick.col, -brick.row - 1)  # -1 because of anchor point
+        sprite.visible = self.shows(brick)
+
+    def place_tile(self, brick):
+        pos = brick.col, brick.row
+        if brick.alive:
+            self.tile_bricks[pos] = brick
+            self.tiles.set(brick.col, brick.row, brick.image_fname, self.shade(pos))
+        elif self.tile_bricks.get(pos) is brick:  # Not already replaced this frame
+            del self.tile_bricks[pos]
+            self.tiles.set(brick.col, brick.row, None)
 
 
     def on_key_press(self, symbol, modifiers):
         super().on_key_press(symbol, modifiers)
-        if symbol == key.R:
-            self.start_game()
-            self.start_level()
+        if symbol in actions:
+            self.press(actions[symbol])
+        if symbol in zoom_keys:
+            self.set_zoom(self.zoom * zoom_keys[symbol])
+        elif symbol == key.R:
+            self.restart()
+        elif symbol == key.M:
+            self.minimap.toggle()
+        elif symbol == key.F3:
+            if self.profiler.enabled:
+                self.profiler.disable()
+                self.profile_label.text = ''
+            else:
+                self.profiler.enable()
+        elif symbol == key.F4:
+            self.profiler.export_json('profile.json')
+            self.profiler.export_csv('profile.csv')
+            log.info("Wrote profile.json and profile.csv")
+        elif symbol == key.F5:
+            self.autosave()
+        elif symbol == key.F9:
+            try:
+                if self.journal is None:
+                    restore(self, load(self.SAVE_FILE))
+                else:
+                    # Recorded whole, as the file may be saved over before the replay
+                    with open(self.SAVE_FILE, 'rb') as f:
+                        data = f.read()
+                    restore(self, loads(data))
+                    self.journal.append((self.clock.ticks, 'load', base64.b64encode(data).decode()))
+            except (OSError, ValueError) as e:
+                log.info("Could not load %s: %s", self.SAVE_FILE, e)
+                return
+            self.saver.full = True
+
+    def autosave(self, dt=None):
+        if self.hero and self.hero.health > 0:
+            self.saver.save()
 
+    def on_key_release(self, symbol, modifiers):
+        if symbol in actions:
+            self.release(actions[symbol])
+
+    def close(self):
+        self.planner.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
+
+    def start_level(self):
+        super().start_level()
+        self.follow_hero()
+        self.update_fog()
+
+    def hero_moved(self):
+        super().hero_moved()
+        self.follow_hero()
+        self.update_fog()
 
     def update(self, dt):
-        pass
+        self.advance(dt, self.MAX_STEPS)  # Drawing happens at its own rate in on_draw
+
+
+class ChunkedGame(ChunkedWorld, Game):
+
+    def clamp_view(self, col, row, cols, rows):
+        return col, row  # No edges
 
 
 if __name__ == "__main__":
+    configure_logging('--debug' in sys.argv)
     pyglet.resource.path = ['res']
     pyglet.resource.reindex()
-    window = Game()
-pyglet.app.run()
+    Game.HUD_GLYPHS = '--glyph-hud' in sys.argv
+    Game.FOG = '--no-fog' not in sys.argv
+    seed = int(sys.argv[sys.argv.index('--seed') + 1]) if '--seed' in sys.argv else None
+    window = ChunkedGame(seed) if '--chunked' in sys.argv else Game(seed)
+    recorder = Recorder(window) if '--record' in sys.argv else None
+    pyglet.app.run()
+    if recorder:
+        recorder.save(sys.argv[sys.argv.index('--record') + 1])
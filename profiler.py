@@ -0,0 +1,150 @@
+import csv
+import json
+import logging as log
+import time
+from collections import deque
+
+import engine
+
+
+def configure_logging(debug=False):
+    # engine.DEBUG gates the per step/per brick debug lines, so they cost
+    # nothing unless debug logging is really on
+    log.basicConfig(level=log.DEBUG if debug else log.INFO, format = '%(asctime)s %(message)s')
+    engine.DEBUG = debug
+
+
+class Section:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+
+
+class Profiler:
+    # Timers and counters per frame, the last FRAMES frames kept in a ring
+    # buffer. Disabled it leaves no wrappers behind, so it costs nothing.
+    FRAMES = 600
+
+    def __init__(self, world):
+        self.world = world
+        self.enabled = False
+        self.frames = deque(maxlen=self.FRAMES)
+        self.stats = {}  # Name -> [calls, seconds] in the current frame
+        self.patched = []
+        self.frame_count = 0
+        self.frame_started = time.perf_counter()
+
+    def add(self, name, seconds, calls=1):
+        entry = self.stats.get(name)
+        if entry is None:
+            self.stats[name] = [calls, seconds]
+        else:
+            entry[0] += calls
+            entry[1] += seconds
+
+    def count(self, name, calls=1):
+        self.add(name, 0.0, calls)
+
+    def section(self, name):
+        return Section(self, name)
+
+    def timed(self, func, name):
+        add, timer = self.add, time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add(name, timer() - start)
+        return timed
+
+    def wrap(self, owner, attr, name):
+        self.patched.append((owner, attr, vars(owner).get(attr)))
+        setattr(owner, attr, self.timed(getattr(owner, attr), name))
+
+    def instrument(self, func):
+        return self.timed(func, func.__qualname__)
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.wrap(engine.Hero, 'step', 'Hero.step')
+        self.wrap(engine.World, 'check_collision', 'check_collision')
+        self.wrap(engine.World, 'start_level', 'start_level')
+        # Scheduled callbacks are wrapped inside the clock instead, so the
+        # bound methods entities unschedule stay the same
+        clock = self.world.clock
+        clock.instrument = self.instrument
+        for entries in clock.entries.values():
+            for entry in entries:
+                entry[4] = self.instrument(entry[0])
+        self.frame_started = time.perf_counter()
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        for owner, attr, original in reversed(self.patched):
+            if original is None:
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, original)
+        self.patched = []
+        clock = self.world.clock
+        clock.instrument = None
+        for entries in clock.entries.values():
+            for entry in entries:
+                entry[4] = entry[0]
+        self.stats = {}
+
+    def end_frame(self):
+        now = time.perf_counter()
+        self.frames.append((now - self.frame_started, self.stats))
+        self.frame_started = now
+        self.frame_count += 1
+        self.stats = {}
+
+    def summary(self, frames=60):
+        # Name -> (calls, milliseconds) per frame, averaged over recent frames
+        recent = list(self.frames)[-frames:]
+        totals = {}
+        for frame_time, stats in recent:
+            for name, (calls, seconds) in stats.items():
+                total = totals.setdefault(name, [0, 0.0])
+                total[0] += calls
+                total[1] += seconds
+        n = max(1, len(recent))
+        result = {name: (calls / n, seconds * 1000 / n) for name, (calls, seconds) in totals.items()}
+        result['frame'] = (1.0, sum(frame_time for frame_time, stats in recent) * 1000 / n)
+        return result
+
+    def report(self, frames=60):
+        lines = ["%-24s %8s %8s" % ('', 'calls', 'ms')]
+        for name, (calls, ms) in sorted(self.summary(frames).items(), key=lambda item: -item[1][1]):
+            lines.append("%-24s %8.1f %8.3f" % (name, calls, ms))
+        return '\n'.join(lines)
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump([{'frame_ms': frame_time * 1000,
+                        'stats': {name: {'calls': calls, 'ms': seconds * 1000}
+                                  for name, (calls, seconds) in stats.items()}}
+                       for frame_time, stats in self.frames], f, indent=1)
+
+    def export_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame', 'frame_ms', 'name', 'calls', 'ms'])
+            for i, (frame_time, stats) in enumerate(self.frames):
+                for name, (calls, seconds) in sorted(stats.items()):
+                    writer.writerow([i, '%.4f' % (frame_time * 1000), name, calls, '%.4f' % (seconds * 1000)])
@@ -0,0 +1,169 @@
+import argparse
+import base64
+import json
+import logging as log
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+from chunks import ChunkedWorld
+from engine import World
+from savegame import Saver, loads, restore
+
+
+WORLDS = {'World': World, 'ChunkedWorld': ChunkedWorld}
+ACTIONS = {action.__name__: action for action in (
+        engine.UP, engine.RIGHT, engine.DOWN, engine.LEFT, engine.ACTION)}
+CHECK_TICKS = 6000
+HOLD = 50  # Ticks a random key is held for in a checked session
+
+
+class ReplayMismatch(Exception):
+    pass
+
+
+class Recorder:
+    # Logs a world's input per tick plus a state hash every CHECK_EVERY ticks.
+    # A save loaded while recording goes in the log whole.
+    # Attach before the first restart() so the replay starts from the same tick.
+    CHECK_EVERY = 100
+
+    def __init__(self, world):
+        self.world = world
+        self.events = world.journal = []
+        self.hashes = []
+        world.clock.schedule_interval(self.checkpoint, self.CHECK_EVERY * world.clock.TICK)
+
+    def checkpoint(self, dt):
+        self.hashes.append((self.world.clock.ticks, self.world.state_hash()))
+
+    def session(self):
+        world = self.world
+        for base in type(world).__mro__:
+            if base.__name__ in WORLDS:
+                break
+        return {
+            'version': 1,
+            'world': base.__name__,
+            'seed': world.seed,
+            'check_every': self.CHECK_EVERY,
+            'ticks': world.clock.ticks,
+            'events': self.events,
+            'hashes': self.hashes,
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.session(), f)
+
+
+def load(path):
+    with open(path) as f:
+        session = json.load(f)
+    if session['version'] != 1:
+        raise ValueError("Unknown session version %s" % session['version'])
+    return session
+
+
+def replay(session, verify=True):
+    # Plays a recorded session back headless, as fast as the CPU goes, and
+    # checks the world ends up in the same state at every checkpoint
+    world = WORLDS[session['world']](seed=session['seed'])
+    hashes = []
+    world.clock.schedule_interval(lambda dt: hashes.append((world.clock.ticks, world.state_hash())),
+            session['check_every'] * world.clock.TICK)
+    events = session['events']
+    expected = {tick: digest for tick, digest in session['hashes']}
+
+    started = time.perf_counter()
+    i = 0
+    for tick in range(session['ticks'] + 1):
+        while i < len(events) and events[i][0] == tick:
+            tick_, kind, action = events[i]
+            if kind == 'restart':
+                world.restart()
+            elif kind == 'load':
+                restore(world, loads(base64.b64decode(action)))
+            elif kind == 'press':
+                world.press(ACTIONS[action])
+            else:
+                world.release(ACTIONS[action])
+            i += 1
+        if tick == session['ticks']:
+            break
+        world.clock.step()
+        world.dirty.clear()
+        if verify and hashes and hashes[-1][0] == world.clock.ticks:
+            checked_tick, digest = hashes[-1]
+            if expected.get(checked_tick, digest) != digest:
+                raise ReplayMismatch("State differs at tick %s" % checked_tick)
+    seconds = time.perf_counter() - started
+    return {'ticks': session['ticks'], 'seconds': seconds,
+            'ticks_per_second': session['ticks'] / seconds if seconds else 0.0,
+            'state_hash': world.state_hash()}
+
+
+def record(world_name, seed, ticks=CHECK_TICKS):
+    # A session of random keys held HOLD ticks each, with a save made a
+    # quarter of the way in and loaded back halfway
+    world = WORLDS[world_name](seed=seed)
+    recorder = Recorder(world)
+    rng = random.Random(seed)
+    directions = [ACTIONS[name] for name in ('UP', 'RIGHT', 'DOWN', 'LEFT')]
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'save.bin')
+        saver = Saver(world, path)
+        world.restart()
+        for tick in range(ticks):
+            if world.hero.health <= 0:
+                world.restart()
+            if tick % HOLD == 0:
+                for action in list(world.keys):
+                    world.release(action)
+                world.press(rng.choice(directions))
+                world.press(engine.ACTION)
+            if tick == ticks // 4:
+                saver.save(wait=True)
+            elif tick == ticks // 2:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                restore(world, loads(data))
+                world.journal.append((world.clock.ticks, 'load', base64.b64encode(data).decode()))
+            world.clock.step()
+            world.dirty.clear()
+    return recorder.session()
+
+
+def check(seeds, ticks=CHECK_TICKS):
+    # Records a session per seed and world, and replays each in a fresh
+    # process, where object ids and so set orders differ: nothing the game
+    # does may hang on them. Raises ReplayMismatch if one plays differently.
+    sessions = [record(name, seed, ticks) for name in sorted(WORLDS) for seed in seeds]
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(replay, sessions))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded session headless")
+    parser.add_argument('session', nargs='?')
+    parser.add_argument('--no-verify', action='store_true')
+    parser.add_argument('--check', type=int, metavar='N',
+            help="record N sessions of random input per world and replay them in fresh processes")
+    args = parser.parse_args(argv)
+    log.basicConfig(level=log.INFO, format = '%(asctime)s %(message)s')
+    if args.check:
+        results = check(range(args.check))
+        log.info("%s sessions replayed the same", len(results))
+        return
+    if not args.session:
+        parser.error("a session to replay, or --check")
+    result = replay(load(args.session), verify=not args.no_verify)
+    log.info("%(ticks)s ticks in %(seconds).2f s, %(ticks_per_second).0f ticks/s", result)
+
+
+if __name__ == "__main__":
+    main()
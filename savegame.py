@@ -0,0 +1,346 @@
+import logging as log
+import mmap
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from chunks import ChunkedWorld
+from dungeon import VISITED_FLOOR, VISITED_WALL, Dungeon
+from engine import (DIRECTIONS, Armor, Chest, Door, LevelBuild, Monster, RandomStreams, Sword,
+        stage_tiles)
+
+
+# A save file is a full block, then any number of incremental blocks that
+# only hold what changed since the block before. Each block is a BLOCK
+# header and a payload of, in order: STATE, HERO, an RNG for each random
+# stream drawn from since (STATE.streams has a bit per stream), HERD_RNG, the dungeon grid (full blocks of a World only), the
+# loaded chunks, then the evicted ones and the LEFT records of what is left in
+# them (ChunkedWorld only), the item keys and monster slots gone
+# since the last block, then ITEM and MONSTER records. Everything is fixed
+# width little endian, so loading is np.frombuffer over an mmap.
+MAGIC = b'RPGS'
+VERSION = 2
+BLOCK = np.dtype([('magic', 'S4'), ('version', '<u2'), ('full', 'u1'), ('chunked', 'u1'),
+                  ('size', '<u4')])
+STATE = np.dtype([('seed', '<i8'), ('depth', '<i4'), ('columns', '<i4'), ('rows', '<i4'),
+                  ('next_seed', '<i8'), ('next_col', '<i4'), ('next_row', '<i4'),
+                  ('streams', '<u4'), ('chunks', '<u4'), ('evicted', '<u4'), ('left', '<u4'),
+                  ('gone_items', '<u4'), ('gone_monsters', '<u4'),
+                  ('items', '<u4'), ('monsters', '<u4')])
+HERO_FIELDS = ('col', 'row', 'health', 'max_health', 'potion', 'xp', 'level', 'armor', 'max_armor',
+               'sword', 'max_sword', 'attack', 'defense')
+HERO = np.dtype([(name, '<i4') for name in HERO_FIELDS] + [('direction', 'u1')])
+RNG = np.dtype([('mt', '<u4', 625), ('gauss', '<f8')])  # random.Random.getstate()
+HERD_RNG = np.dtype([('state', '<u8', 2), ('inc', '<u8', 2), ('has_uint32', '<u4'),
+                     ('uinteger', '<u4')])
+CHUNK = np.dtype([('cx', '<i4'), ('cy', '<i4')])
+ITEM = np.dtype([('key', '<u4'), ('kind', 'u1'), ('open', 'u1'), ('col', '<i4'), ('row', '<i4'),
+                 ('image', 'S24')])
+MONSTER = np.dtype([('slot', '<u4'), ('fighting', 'u1'), ('col', '<i4'), ('row', '<i4'),
+                    ('hp', '<i4'), ('attack', '<i4'), ('defense', '<i4'), ('xp', '<i4')])
+LEFT = np.dtype([('cx', '<i4'), ('cy', '<i4'), ('kind', 'u1'), ('col', '<i4'), ('row', '<i4'),
+                 ('image', 'S24'), ('hp', '<i4'), ('attack', '<i4'), ('defense', '<i4'), ('xp', '<i4')])
+ITEM_KINDS = (Chest, Door, Armor, Sword)
+LEFT_KINDS = (Monster,) + ITEM_KINDS
+NO_SEED = -1
+
+
+def split128(n):
+    return [n & 0xFFFFFFFFFFFFFFFF, n >> 64]
+
+
+class Saver:
+    # Writes a world's snapshots to path: a full one the first time and
+    # whenever the grid changed, else one appended with just the changes.
+    # The bytes are put together at once, the writing is done on a thread.
+
+    def __init__(self, world, path):
+        self.world = world
+        self.path = path
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.floor = None  # world.floor at the last full save
+        self.full = True
+        self.keys = {}  # Item brick -> its key in the file
+        self.next_key = 0
+        self.items = {}  # Key -> ITEM record bytes as last saved
+        self.monsters = np.zeros(0, MONSTER)  # As last saved, by herd slot
+        self.streams = [None] * len(RandomStreams.NAMES)  # RNG records as last saved
+        self.saved = None  # Future of the last write
+
+    def state(self, streams, chunks, evicted, left, gone_items, gone_monsters, items, monsters):
+        world = self.world
+        state = np.zeros(1, STATE)
+        state['seed'] = world.seed
+        state['depth'] = getattr(world, 'depth', 0)
+        state['columns'], state['rows'] = world.COLUMNS, world.ROWS
+        state['next_seed'] = NO_SEED
+        build = world.next_level
+        if build is not None:
+            state['next_seed'] = build.args[0]
+            state['next_col'], state['next_row'] = build.start
+        state['streams'] = streams
+        state['chunks'], state['evicted'], state['left'] = chunks, evicted, left
+        state['gone_items'], state['gone_monsters'] = gone_items, gone_monsters
+        state['items'], state['monsters'] = items, monsters
+        return state
+
+    def hero(self):
+        hero = self.world.hero
+        record = np.zeros(1, HERO)
+        for name in HERO_FIELDS:
+            record[name] = getattr(hero, name)
+        record['direction'] = DIRECTIONS.index(hero.direction)
+        return record
+
+    def rngs(self, full):
+        # Bit mask and records of the streams drawn from since the last save
+        mask, records = 0, []
+        for i, name in enumerate(RandomStreams.NAMES):
+            version, mt, gauss = getattr(self.world.rng, name).getstate()
+            record = np.array([(mt, np.nan if gauss is None else gauss)], RNG).tobytes()
+            if full or record != self.streams[i]:
+                mask |= 1 << i
+                records.append(record)
+                self.streams[i] = record
+        state = self.world.herd.rng.bit_generator.state
+        herd = np.zeros(1, HERD_RNG)
+        herd['state'] = split128(state['state']['state'])
+        herd['inc'] = split128(state['state']['inc'])
+        herd['has_uint32'], herd['uinteger'] = state['has_uint32'], state['uinteger']
+        return mask, b''.join(records), herd
+
+    def item_records(self):
+        world = self.world
+        bricks = list(world.chests) + list(world.doors) + list(world.loot)
+        records = np.zeros(len(bricks), ITEM)
+        keys = {}
+        for i, brick in enumerate(bricks):
+            key = self.keys.get(brick)
+            if key is None:
+                key = self.next_key
+                self.next_key += 1
+            keys[brick] = key
+            records[i] = (key, ITEM_KINDS.index(type(brick)), getattr(brick, 'is_open', False),
+                          brick.col, brick.row, brick.image_fname.encode())
+        self.keys = keys
+        return records
+
+    def monster_records(self):
+        herd = self.world.herd
+        records = np.zeros(len(herd.used), MONSTER)
+        records['slot'] = np.arange(len(herd.used))
+        records['fighting'] = herd.used.astype(bool) & (herd.next_tick == herd.IDLE) & (herd.asleep == 0)
+        for name in ('col', 'row', 'hp', 'attack', 'defense', 'xp'):
+            records[name] = getattr(herd, name)
+        return records, herd.used.astype(bool)
+
+    def left_records(self):
+        # The evicted chunks of a ChunkedWorld and what each has left in it
+        left = self.world.left
+        records = np.zeros(sum(len(bricks) for bricks in left.values()), LEFT)
+        i = 0
+        for (cx, cy), bricks in left.items():
+            for kind, col, row, image_fname, stats in bricks:
+                records[i] = (cx, cy, LEFT_KINDS.index(kind), col, row, image_fname.encode()) + (stats or (0, 0, 0, 0))
+                i += 1
+        return np.array(list(left), CHUNK), records
+
+    def snapshot(self):
+        # One block of bytes, full or incremental
+        world = self.world
+        full = self.full or world.floor is not self.floor
+        chunked = isinstance(world, ChunkedWorld)
+        items = self.item_records()
+        monsters, used = self.monster_records()
+
+        if full:
+            gone_items = np.zeros(0, '<u4')
+            gone_monsters = np.zeros(0, '<u4')
+            changed_items = items
+            changed_monsters = monsters[used]
+        else:
+            keys = set(items['key'].tolist())
+            gone_items = np.array([key for key in self.items if key not in keys], '<u4')
+            changed_items = items[[self.items.get(key) != record.tobytes()
+                                   for key, record in zip(items['key'].tolist(), items)]]
+            last = np.zeros(len(monsters), MONSTER)
+            last[:len(self.monsters)] = self.monsters[:len(monsters)]
+            was_used = np.zeros(len(monsters), bool)
+            was_used[:len(self.monsters)] = self.monsters['slot'][:len(monsters)] != np.iinfo('<u4').max
+            gone_monsters = np.flatnonzero(was_used & ~used).astype('<u4')
+            changed_monsters = monsters[used & (~was_used | (monsters != last))]
+
+        parts = []
+        if full and not chunked:
+            parts.append(np.where(world.floor, VISITED_FLOOR, VISITED_WALL).astype(np.uint8).tobytes())
+        chunks = np.array(list(world.chunks), CHUNK) if chunked else np.zeros(0, CHUNK)
+        evicted, left = self.left_records() if chunked else (np.zeros(0, CHUNK), np.zeros(0, LEFT))
+        parts += [chunks.tobytes(), evicted.tobytes(), left.tobytes()]
+        mask, streams, herd = self.rngs(full)
+        payload = b''.join([
+                self.state(mask, len(chunks), len(evicted), len(left), len(gone_items), len(gone_monsters),
+                           len(changed_items), len(changed_monsters)).tobytes(),
+                self.hero().tobytes(), streams, herd.tobytes()]
+                + parts
+                + [gone_items.tobytes(), gone_monsters.tobytes(),
+                   changed_items.tobytes(), changed_monsters.tobytes()])
+        header = np.array([(MAGIC, VERSION, full, chunked, len(payload))], BLOCK)
+
+        self.full = False
+        self.floor = world.floor
+        self.items = {key: record.tobytes() for key, record in zip(items['key'].tolist(), items)}
+        monsters['slot'][~used] = np.iinfo('<u4').max  # Marks free slots
+        self.monsters = monsters
+        return full, header.tobytes() + payload
+
+    def save(self, wait=False):
+        full, block = self.snapshot()
+        self.saved = self.writer.submit(self.write, full, block)
+        if wait:
+            self.saved.result()
+        return self.saved
+
+    def write(self, full, block):
+        if full:
+            temp = self.path + '.tmp'
+            with open(temp, 'wb') as f:
+                f.write(block)
+            os.replace(temp, self.path)
+        else:
+            with open(self.path, 'ab') as f:
+                f.write(block)
+        log.debug("Saved %s bytes, %s", len(block), 'full' if full else 'changes')
+
+
+class Snapshot:
+    # A save file read back: the last block's state, hero and random
+    # streams, the grid of the full block and every block's changes applied
+
+    def __init__(self, data, name='save'):
+        self.state = None
+        self.streams = [None] * len(RandomStreams.NAMES)  # RNG record of each stream
+        self.grid = None
+        self.items = {}  # Key -> ITEM record
+        self.monsters = {}  # Slot -> MONSTER record
+        offset = 0
+        while offset < len(data):
+            header = np.frombuffer(data, BLOCK, 1, offset).copy()[0]
+            if header['magic'] != MAGIC or header['version'] != VERSION:
+                raise ValueError("Not a version %s save: %s" % (VERSION, name))
+            offset += BLOCK.itemsize
+            if self.state is None and not header['full']:
+                raise ValueError("Save does not start with a full snapshot: %s" % name)
+            self.read_block(data, offset, bool(header['full']), bool(header['chunked']))
+            offset += int(header['size'])
+
+    def read_block(self, data, offset, full, chunked):
+        def take(dtype, count=1):
+            nonlocal offset
+            # Copied out of the mmap, which is closed after loading
+            array = np.frombuffer(data, dtype, count, offset).copy()
+            offset += dtype.itemsize * count
+            return array
+
+        self.chunked = chunked
+        state = self.state = take(STATE)[0]
+        self.hero = take(HERO)[0]
+        for i in range(len(RandomStreams.NAMES)):
+            if state['streams'] >> i & 1:
+                self.streams[i] = take(RNG)[0]
+        self.herd_rng = take(HERD_RNG)[0]
+        if full:
+            self.items, self.monsters = {}, {}
+            if not chunked:
+                self.grid = take(np.dtype('u1'), int(state['columns']) * int(state['rows']))
+        self.chunks = take(CHUNK, int(state['chunks']))
+        self.evicted = take(CHUNK, int(state['evicted']))
+        self.left = take(LEFT, int(state['left']))
+        for key in take(np.dtype('<u4'), int(state['gone_items'])).tolist():
+            del self.items[key]
+        for slot in take(np.dtype('<u4'), int(state['gone_monsters'])).tolist():
+            del self.monsters[slot]
+        for record in take(ITEM, int(state['items'])):
+            self.items[int(record['key'])] = record
+        for record in take(MONSTER, int(state['monsters'])):
+            self.monsters[int(record['slot'])] = record
+
+
+def load(path):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return Snapshot(data, path)
+
+
+def loads(data):
+    # A save held in memory, as replay.Recorder journals it
+    return Snapshot(data)
+
+
+def restore(world, snapshot):
+    # Puts world in the saved state. The clock keeps its own time.
+    if snapshot.chunked != isinstance(world, ChunkedWorld):
+        raise ValueError("Save is of a %s world" % ('chunked' if snapshot.chunked else 'fixed size'))
+    state = snapshot.state
+    world.seed = int(state['seed'])
+    world.COLUMNS, world.ROWS = int(state['columns']), int(state['rows'])
+    if world.hero is None:
+        world.start_game()
+    world.next_level = None
+    world.clear_level()
+
+    hero, saved = world.hero, snapshot.hero
+    for name in HERO_FIELDS:
+        if name not in ('col', 'row'):
+            setattr(hero, name, int(saved[name]))
+    hero.direction = DIRECTIONS[saved['direction']]
+    hero.image_fname = hero.direction.image_fname
+    hero.move_cell(int(saved['col']), int(saved['row']))
+
+    if snapshot.chunked:
+        world.depth = int(state['depth'])
+        world.chunks = OrderedDict()
+        for cx, cy in snapshot.chunks.tolist():
+            world.chunks[cx, cy] = None
+            world.load_chunk(cx, cy, spawn=False)
+        world.left = {(cx, cy): [] for cx, cy in snapshot.evicted.tolist()}
+        for record in snapshot.left:
+            kind = LEFT_KINDS[record['kind']]
+            stats = tuple(int(record[name]) for name in ('hp', 'attack', 'defense', 'xp')) if kind is Monster else None
+            world.left[int(record['cx']), int(record['cy'])].append(
+                    (kind, int(record['col']), int(record['row']), record['image'].decode(), stats))
+    else:
+        dungeon = Dungeon(world.COLUMNS, world.ROWS, bytearray(snapshot.grid))
+        bricks, cells = set(), {}
+        for brick in stage_tiles(dungeon, bricks, cells):
+            pass
+        world.enter_level(dungeon, bricks, cells)
+
+    for record in snapshot.items.values():
+        brick = ITEM_KINDS[record['kind']](int(record['col']), int(record['row']))
+        brick.image_fname = record['image'].decode()
+        if record['open']:
+            brick.open()
+    for record in snapshot.monsters.values():
+        monster = Monster(int(record['col']), int(record['row']))
+        for name in ('hp', 'attack', 'defense', 'xp'):
+            setattr(monster, name, int(record[name]))
+        if record['fighting']:
+            monster.start_fight()
+
+    # Last, as making the bricks above drew from them
+    for name, stream in zip(RandomStreams.NAMES, snapshot.streams):
+        gauss = float(stream['gauss'])
+        getattr(world.rng, name).setstate((3, tuple(stream['mt'].tolist()), None if gauss != gauss else gauss))
+    herd_rng = snapshot.herd_rng
+    world.herd.rng.bit_generator.state = {
+            'bit_generator': 'PCG64',
+            'state': {'state': int(herd_rng['state'][0]) | int(herd_rng['state'][1]) << 64,
+                      'inc': int(herd_rng['inc'][0]) | int(herd_rng['inc'][1]) << 64},
+            'has_uint32': int(herd_rng['has_uint32']), 'uinteger': int(herd_rng['uinteger'])}
+    if state['next_seed'] != NO_SEED:
+        world.next_level = LevelBuild(world, (int(state['next_col']), int(state['next_row'])),
+                                      int(state['next_seed']))
+    world.set_message("")
+    world.set_label_text()
+    world.hero_moved()
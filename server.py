@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import json
+import logging as log
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from chunks import ChunkedWorld
+from bots import size
+from engine import Floor, Wall, World
+from replay import ACTIONS
+
+
+HOST = '127.0.0.1'
+PORT = 7777
+HERO_FIELDS = ('col', 'row', 'health', 'max_health', 'xp', 'level', 'potion', 'armor', 'sword')
+
+
+def encode(message):
+    return json.dumps(message, separators=(',', ':')).encode() + b'\n'
+
+
+class Connection:
+    __slots__ = ('writer', 'spectator', 'resync')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.spectator = False
+        self.resync = True  # Gets a full snapshot next, not a delta
+
+
+class Server:
+    # Runs a world at real time and streams it to every client over a line
+    # of JSON per frame. A new client, or one too slow to keep up, gets a
+    # full snapshot; the others get the bricks in world.dirty since the last
+    # frame. A delta is encoded once and the same bytes go to every client.
+    # Floors and walls of a fixed size level go as one grid when the level
+    # changes, not brick by brick.
+    RATE = 60  # Frames per second, each sends what all its ticks changed
+    MAX_STEPS = 10  # Simulation ticks per frame at most, a longer stall is dropped
+    BUFFER_LIMIT = 1 << 20  # Bytes queued for a client before it is resynced instead
+
+    def __init__(self, world):
+        self.world = world
+        self.connections = set()
+        self.ids = {}  # Brick -> the id clients know it by
+        self.next_id = 0
+        self.walls_version = None
+        self.hero = None
+        self.message = None
+        self.sent = 0  # Bytes, over all clients
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        log.info("Serving seed %s on %s:%s", self.world.seed, host, port)
+        async with server:
+            await self.run()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        last = loop.time()
+        while True:
+            await asyncio.sleep(max(0.0, last + 1 / self.RATE - loop.time()))
+            now = loop.time()
+            self.world.advance(now - last, self.MAX_STEPS)
+            last = now
+            self.broadcast()
+
+    def brick_id(self, brick):
+        brick_id = self.ids.get(brick)
+        if brick_id is None:
+            brick_id = self.ids[brick] = self.next_id
+            self.next_id += 1
+        return brick_id
+
+    def brick_state(self, brick):
+        return [self.brick_id(brick), type(brick).__name__, brick.col, brick.row, brick.image_fname]
+
+    def sent_as_grid(self, brick):
+        return self.world.floor is not None and isinstance(brick, (Floor, Wall))
+
+    def grid(self):
+        # The level's floor cells as a string per row, '.' floor and '#' wall
+        return [''.join('.' if cell else '#' for cell in row) for row in self.world.floor.tolist()]
+
+    def hero_state(self):
+        hero = self.world.hero
+        return [getattr(hero, name) for name in HERO_FIELDS] if hero else None
+
+    def delta(self):
+        # What changed since the last frame, consuming world.dirty
+        world = self.world
+        dirty, world.dirty = world.dirty, set()
+        message = {'tick': world.clock.ticks}
+        changed, gone = [], []
+        for brick in dirty:
+            if self.sent_as_grid(brick):
+                continue
+            if brick.alive:
+                changed.append(self.brick_state(brick))
+            elif brick in self.ids:
+                gone.append(self.ids.pop(brick))
+        if world.walls_version != self.walls_version:
+            self.walls_version = world.walls_version
+            if world.floor is not None:
+                message['grid'] = self.grid()
+            # A new level drops the old one's bricks without marking them dirty
+            for brick in [brick for brick in self.ids if brick not in world.bricks]:
+                gone.append(self.ids.pop(brick))
+        if changed:
+            message['changed'] = changed
+        if gone:
+            message['gone'] = gone
+        hero = self.hero_state()
+        if hero != self.hero:
+            self.hero = message['hero'] = hero
+        if world.message != self.message:
+            self.message = message['message'] = world.message
+        return message
+
+    def snapshot(self):
+        world = self.world
+        message = {'tick': world.clock.ticks, 'full': True, 'hero': self.hero_state(),
+                   'message': world.message,
+                   'bricks': [self.brick_state(brick) for brick in world.bricks
+                              if not self.sent_as_grid(brick)]}
+        if world.floor is not None:
+            message['grid'] = self.grid()
+        return message
+
+    def broadcast(self):
+        delta = self.delta()
+        data = encode(delta) if len(delta) > 1 else None  # More than the tick
+        full = None
+        for connection in self.connections:
+            transport = connection.writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > self.BUFFER_LIMIT:
+                connection.resync = True  # Its deltas would pile up, it catches up in one go
+                continue
+            if connection.resync:
+                if full is None:
+                    full = encode(self.snapshot())
+                connection.writer.write(full)
+                connection.resync = False
+                self.sent += len(full)
+            elif data:
+                connection.writer.write(data)
+                self.sent += len(data)
+
+    async def handle(self, reader, writer):
+        connection = Connection(writer)
+        self.connections.add(connection)
+        log.info("Client %s connected", writer.get_extra_info('peername'))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    log.warning("Dropped a bad message from %s", writer.get_extra_info('peername'))
+                    continue
+                if 'spectate' in message:
+                    connection.spectator = bool(message['spectate'])
+                if not connection.spectator:
+                    self.apply(message.get('inputs', ()))
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(connection)
+            writer.close()
+            log.info("Client %s left", writer.get_extra_info('peername'))
+
+    def apply(self, inputs):
+        # A client's batch of inputs, in the order they were made
+        world = self.world
+        for kind, *args in inputs:
+            if kind == 'restart':
+                world.restart()
+            elif kind in ('press', 'release') and args and args[0] in ACTIONS:
+                if world.hero:
+                    getattr(world, kind)(ACTIONS[args[0]])
+
+
+class Client:
+    # Keeps a copy of the served world up to date from the snapshots, and
+    # sends whatever inputs were made since the last flush() as one batch
+    def __init__(self, spectate=False):
+        self.spectate = spectate
+        self.bricks = {}  # Id -> [id, kind, col, row, image]
+        self.grid = None
+        self.hero = None
+        self.message = None
+        self.tick = 0
+        self.received = 0  # Bytes
+        self.inputs = []
+        self.reader = self.writer = None
+
+    async def connect(self, host=HOST, port=PORT):
+        self.reader, self.writer = await asyncio.open_connection(host, port, limit=1 << 26)
+        self.writer.write(encode({'spectate': self.spectate}))
+
+    def press(self, action):
+        self.inputs.append(['press', action])
+
+    def release(self, action):
+        self.inputs.append(['release', action])
+
+    def restart(self):
+        self.inputs.append(['restart'])
+
+    async def flush(self):
+        if self.inputs:
+            self.writer.write(encode({'inputs': self.inputs}))
+            self.inputs = []
+        await self.writer.drain()
+
+    async def receive(self):
+        # Applies the next snapshot; False once the server is gone
+        line = await self.reader.readline()
+        if not line:
+            return False
+        self.received += len(line)
+        self.apply(json.loads(line))
+        return True
+
+    def apply(self, message):
+        self.tick = message['tick']
+        if message.get('full'):
+            self.bricks = {brick[0]: brick for brick in message['bricks']}
+        for brick in message.get('changed', ()):
+            self.bricks[brick[0]] = brick
+        for brick_id in message.get('gone', ()):
+            self.bricks.pop(brick_id, None)
+        if 'grid' in message:
+            self.grid = message['grid']
+        if 'hero' in message:
+            self.hero = dict(zip(HERO_FIELDS, message['hero'])) if message['hero'] else None
+        if 'message' in message:
+            self.message = message['message']
+
+    def close(self):
+        self.writer.close()
+
+
+async def watch(host, port):
+    # A spectator logging what it receives once a second
+    client = Client(spectate=True)
+    await client.connect(host, port)
+    started, received = time.perf_counter(), 0
+    while await client.receive():
+        now = time.perf_counter()
+        if now - started >= 1:
+            log.info("Tick %s, %s bricks, %.1f KB/s", client.tick, len(client.bricks),
+                    (client.received - received) / (now - started) / 1024)
+            started, received = now, client.received
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a world to clients on localhost, or watch one")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--size', type=size, help="map size, e.g. 64x48")
+    parser.add_argument('--chunked', action='store_true', help="serve an endless chunked level")
+    parser.add_argument('--watch', action='store_true', help="connect as a spectator instead")
+    args = parser.parse_args(argv)
+    log.basicConfig(level=log.INFO, format = '%(asctime)s %(message)s')
+
+    if args.watch:
+        asyncio.run(watch(args.host, args.port))
+        return
+    world = (ChunkedWorld if args.chunked else World)(args.seed)
+    if args.size:
+        world.COLUMNS, world.ROWS = args.size
+    world.planner = ProcessPoolExecutor(max_workers=1)
+    world.restart()
+    try:
+        asyncio.run(Server(world).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()